@@ -37,13 +37,18 @@ Ridor   FP      TN      TP      FN      TP Rate 		FP Rate 		Accuracy
        7390    37935   114194  20930   0.845105237     0.163044677     0.843058149
 """
 
+import os
+import sys
+import json
 import pefile
 import argparse
-import sys
+import multiprocessing
 
 DEBUG = 0
 isDirty = 0
 
+FEATURES = ['DebugSize', 'ImageVersion', 'IatRVA', 'ExportSize', 'ResourceSize', 'VirtualSize2', 'NumberOfSections']
+
 
 # Class to extract data values from PE file and hold them as member variables
 class PEFile:
@@ -59,6 +64,7 @@ class PEFile:
         self.ResourceSize = self.pe.OPTIONAL_HEADER.DATA_DIRECTORY[2].Size
         self.VirtualSize2 = self.pe.sections[1].Misc_VirtualSize
         self.NumberOfSections = self.pe.FILE_HEADER.NumberOfSections
+        self.pe.close()
 
     def DataDump(self):
         print('Starting dump of ' + self.filename)
@@ -71,15 +77,22 @@ class PEFile:
         print('NumberOfSections:' + str(self.NumberOfSections))  # NumberOfSections
         print('Stop')
 
+    def DataDict(self):
+        return {f: getattr(self, f) for f in FEATURES}
+
 
 def printResult(classification):
+    print(resultString(classification))
+
+
+def resultString(classification):
     if classification == 0:
-        print '0'
+        return '0'
     else:
-        print '1'
+        return '1'
 
 
-def runJ48():
+def runJ48(input):
     isDirty = 0
     if input.DebugSize <= 0:
         if input.ExportSize <= 211:
@@ -242,7 +255,7 @@ def runJ48():
 # Might need to add a isDirty = 0 statement if tree results in unclassified result
 
 
-def runJ48Graft():
+def runJ48Graft(input):
     isDirty = 0
     if input.DebugSize <= 0:
         if input.ExportSize <= 211:
@@ -263,7 +276,7 @@ def runJ48Graft():
                             else:
                                 isDirty = 1
                     else:
-                        if input.VirtualSize <= 12:
+                        if input.VirtualSize2 <= 12:
                             if input.NumberOfSections <= 3:
                                 isDirty = 0
                             else:
@@ -525,7 +538,7 @@ def runJ48Graft():
 # Might need to add a isDirty = 0 statement if tree results in unclassified result
 
 
-def runPART():
+def runPART(input):
     isDirty = 0
     if input.DebugSize > 0 and input.ResourceSize > 545 and input.IatRVA <= 94208 and input.NumberOfSections <= 5 and input.ExportSize > 0 and input.NumberOfSections > 3:
         isDirty = 0
@@ -565,7 +578,7 @@ def runPART():
         isDirty = 0
     elif input.ImageVersion > 1010 and input.DebugSize <= 56 and input.VirtualSize2 <= 215376:
         isDirty = 0
-    elif input.ExportSize > 258 and input.NumberOfSection > 3 and input.DebugSize > 0:
+    elif input.ExportSize > 258 and input.NumberOfSections > 3 and input.DebugSize > 0:
         isDirty = 0
     elif input.ExportSize > 262 and input.ImageVersion > 0 and input.NumberOfSections > 7:
         isDirty = 0
@@ -614,7 +627,7 @@ def runPART():
     return isDirty
 
 
-def runRidor():
+def runRidor(input):
     isDirty = 0
     #Except (DebugSize <= 14) and (ImageVersion <= 760) and (VirtualSize2 > 992) and (ExportSize <= 80.5) => isDirty = 1  (1702.0/16.0) [855.0/5.0]
     if input.DebugSize <= 14 and input.ImageVersion <= 760 and input.VirtualSize2 > 992 and input.ExportSize <= 80.5:
@@ -696,74 +709,154 @@ def runRidor():
     return isDirty
 
 
+# Ordinal for model classifier (the -n option) to the model name and rule function
+MODELS = {1: ('J48', runJ48), 2: ('J48Graft', runJ48Graft), 3: ('PART', runPART), 4: ('Ridor', runRidor)}
+
+
+def classify(filename, model=0, verbose=False):
+    """
+    Classify a single file and return a record with the verdict and the vote of each model that was run.
+    The verdict is '0' or '1', or 'UNKNOWN' when running all models (model=0) and they disagree.
+    """
+    record = {'path': filename}
+    try:
+        pe = PEFile(filename)
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+        return record
+
+    ordinals = sorted(MODELS) if model == 0 else [model]
+    votes = {}
+    for i in ordinals:
+        name, rule = MODELS[i]
+        try:
+            votes[name] = rule(pe)
+        except Exception as e:
+            record['error'] = '{} model: {}: {}'.format(name, type(e).__name__, e)
+            return record
+    if len(set(votes.values())) == 1:
+        record['verdict'] = resultString(votes[MODELS[ordinals[0]][0]])
+    else:
+        record['verdict'] = 'UNKNOWN'
+    record['votes'] = votes
+    if verbose:
+        record['features'] = pe.DataDict()
+    return record
+
+
+def classify_unpack(args):
+    """
+    Pass through function for unpacking classify arguments
+    """
+    return classify(*args)
+
+
+def iter_paths(targets):
+    """
+    Expand files, directories (recursively) and '-' (a file list on stdin) into a stream of file paths
+    """
+    for target in targets:
+        if target == '-':
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    yield line
+        elif os.path.isdir(target):
+            for root, dirs, files in os.walk(target):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield target
+
+
+def classify_batch(paths, model=0, verbose=False, processes=None, chunksize=64):
+    """
+    Classify many files on a process pool. Records are yielded in input order.
+    """
+    arguments = ((path, model, verbose) for path in paths)
+    if processes == 1:
+        for record in map(classify_unpack, arguments):
+            yield record
+        return
+    with multiprocessing.Pool(processes) as pool:
+        for record in pool.imap(classify_unpack, arguments, chunksize):
+            yield record
+
+
 # Each algo once; chain results together with equal weight
 # IO routine: supply input file in CMD line; output is MALWARE or CLEAN or UNKNOWN
-# opts: -i=input file; -n=algorithm number (0 for all)| -h = help
+# opts: -f=input file; -n=algorithm number (0 for all)| -h = help
+# Batch mode: any number of files or directories ('-' reads a file list from stdin); output is one JSON record per file
 # Possibilities for features in future versions:
 # v2: Display verbose - display the rules that were invoked while classifying this file as malware
 # v3: Allow rules to be updated (assisted learning occurs)
 
-parser = argparse.ArgumentParser(description='Classify an unknown binary as MALWARE or CLEAN.')
-parser.add_argument('-f', metavar='filename', help='The name of the input file')
-parser.add_argument(
-    '-n',
-    metavar='model',
-    help='The ordinal for model classifier: 0=all (default) | 1=J48 | 2=J48Graft | 3=PART | 4=Ridor')
-parser.add_argument('-v', nargs='?', metavar='verbose', help='Dump the PE data being processed', const='verbose')
 
-args = parser.parse_args()
-
-if not args.f:
-    parser.print_help()
-    sys.exit(0)
-
-input = PEFile(args.f)
-
-# All variables accessible as values of the 'input' object
-if (args.v):
-    input.DataDump()
-
-# Test input args
-if not args.n:
-    args.n = 0
-args.n = int(args.n)
-if args.n < 0 or args.n > 4:
-    parser.print_help()
-    sys.exit(0)
-
-# Options 0: Run all models
-if (args.n == 0):
-    if DEBUG:
-        print 'Processing all...'
-    result1 = runJ48()
-    result2 = runJ48Graft()
-    result3 = runPART()
-    result4 = runRidor()
-    if ((result1 == result2) and (result2 == result3) and (result3 == result4)):
-        printResult(result1)
-    else:
-        print 'UNKNOWN'
-
-# Options 1:  Run J48
-if (args.n == 1):
-    if DEBUG:
-        print 'Processing J48...'
-    printResult(runJ48())
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Classify an unknown binary as MALWARE or CLEAN.')
+    parser.add_argument('-f', metavar='filename', help='The name of the input file')
+    parser.add_argument(
+        '-n',
+        metavar='model',
+        help='The ordinal for model classifier: 0=all (default) | 1=J48 | 2=J48Graft | 3=PART | 4=Ridor')
+    parser.add_argument('-v', nargs='?', metavar='verbose', help='Dump the PE data being processed', const='verbose')
+    parser.add_argument(
+        'paths',
+        nargs='*',
+        metavar='path',
+        help='Batch mode: files or directories to classify, - reads paths from stdin')
+    parser.add_argument(
+        '-j', metavar='jobs', type=int, default=None, help='Batch mode: number of worker processes (default: all cpus)')
+
+    args = parser.parse_args(argv)
+
+    if not args.f and not args.paths:
+        parser.print_help()
+        return 0
+
+    # Test input args
+    if not args.n:
+        args.n = 0
+    args.n = int(args.n)
+    if args.n < 0 or args.n > 4:
+        parser.print_help()
+        return 0
+
+    # Batch mode: one JSON record per file
+    if args.paths:
+        targets = ([args.f] if args.f else []) + args.paths
+        for record in classify_batch(iter_paths(targets), args.n, bool(args.v), args.j):
+            print(json.dumps(record))
+        return 0
+
+    input = PEFile(args.f)
+
+    # All variables accessible as values of the 'input' object
+    if (args.v):
+        input.DataDump()
+
+    # Options 0: Run all models
+    if (args.n == 0):
+        if DEBUG:
+            print('Processing all...')
+        result1 = runJ48(input)
+        result2 = runJ48Graft(input)
+        result3 = runPART(input)
+        result4 = runRidor(input)
+        if ((result1 == result2) and (result2 == result3) and (result3 == result4)):
+            printResult(result1)
+        else:
+            print('UNKNOWN')
+        return 0
 
-# Options 2:  Run J48
-if (args.n == 2):
+    # Options 1-4: Run a single model
+    name, run = MODELS[args.n]
     if DEBUG:
-        print 'Processing J48Graft...'
-    printResult(runJ48Graft())
+        print('Processing ' + name + '...')
+    printResult(run(input))
+    return 0
 
-# Option 3:  Run PART
-if (args.n == 3):
-    if DEBUG:
-        print 'Processing PART...'
-    printResult(runPART())
 
-# Option 4:  Run Ridor
-if (args.n == 4):
-    if DEBUG:
-        print 'Processing Ridor...'
-    printResult(runRidor())
+if __name__ == '__main__':
+    sys.exit(main())
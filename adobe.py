@@ -1,18 +1,152 @@
 #!/usr/bin/env python
 
+# Only NumPy, pefile and the NumPy-only feature_store, metadata_store, raw_feature_io and header_pack are imported at
+# module load so that scoring with AdobeEval stays cheap to start. The training and analysis dependencies (ember,
+# lightgbm, pandas, sklearn, tqdm) are imported inside the functions that use them.
 import os
-import tqdm
+import ast
 import glob
 import json
-import ember
+import mmap
+import struct
+import inspect
+import tarfile
+import zipfile
+import textwrap
 import pefile
 import numpy as np
-import pandas as pd
-import lightgbm as lgb
 import multiprocessing
-from sklearn.model_selection import GridSearchCV
-from sklearn.model_selection import TimeSeriesSplit
-from sklearn.metrics import (roc_auc_score, make_scorer)
+import feature_store
+import metadata_store
+import raw_feature_io
+import header_pack
+
+
+def raw_feature_values(raw_features):
+    """
+    Extract the Adobe features, in AdobeEval.ordered_features order, from an EMBER raw features dictionary
+    """
+    sections = raw_features["section"]["sections"]
+    return (
+        raw_features["datadirectories"][6]["size"],
+        ((raw_features["header"]["optional"]["major_image_version"] * 100 +
+          raw_features["header"]["optional"]["minor_image_version"]) * 1000),
+        raw_features["datadirectories"][1]["virtual_address"],
+        raw_features["datadirectories"][0]["size"],
+        raw_features["datadirectories"][2]["size"],
+        0 if len(sections) < 2 else sections[1]["vsize"],
+        len(sections),
+    )
+
+
+def pe_feature_values(pef):
+    """
+    Extract the Adobe features, in AdobeEval.ordered_features order, from a parsed pefile.PE object
+    """
+    return (
+        pef.OPTIONAL_HEADER.DATA_DIRECTORY[6].Size,
+        ((pef.OPTIONAL_HEADER.MajorImageVersion * 100) + pef.OPTIONAL_HEADER.MinorImageVersion) * 1000,
+        pef.OPTIONAL_HEADER.DATA_DIRECTORY[1].VirtualAddress,
+        pef.OPTIONAL_HEADER.DATA_DIRECTORY[0].Size,
+        pef.OPTIONAL_HEADER.DATA_DIRECTORY[2].Size,
+        0 if len(pef.sections) < 2 else pef.sections[1].Misc_VirtualSize,
+        pef.FILE_HEADER.NumberOfSections,
+    )
+
+
+def header_length(data):
+    """
+    Return the number of bytes from the start of a PE file up to the end of its section table, which holds every
+    header the Adobe features are read from, given at least its first 64 bytes
+    """
+    e_lfanew = struct.unpack_from("<I", data, 0x3c)[0]
+    if len(data) < e_lfanew + 24:
+        return e_lfanew + 24
+    number_of_sections, = struct.unpack_from("<H", data, e_lfanew + 6)
+    size_of_optional_header, = struct.unpack_from("<H", data, e_lfanew + 20)
+    return e_lfanew + 24 + size_of_optional_header + 40 * number_of_sections
+
+
+def read_header(f, initial_size=4096, max_size=1 << 20):
+    """
+    Read only the header region of the PE file open as f, which may be an unseekable archive member stream
+    """
+    data = f.read(initial_size)
+    while len(data) >= 64:
+        length = header_length(data)
+        if length <= len(data) or length > max_size:
+            break
+        more = f.read(length - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def buffer_feature_values(data):
+    """
+    Extract the Adobe features, in AdobeEval.ordered_features order, from the bytes of a PE file or of just its header
+    region from read_header, as for archive members and HeaderPack entries. A header region alone can give different
+    features than the whole file: pefile reports the raw data of sections that lies past the buffer as beyond the end
+    of the file, and a section that also has a huge VirtualSize makes it stop parsing the section table, so
+    VirtualSize2 reads as 0. Files on disk go through path_feature_values instead.
+    """
+    # PE.close() only releases the mmap of a file opened by path, and it runs a full gc.collect() that costs three times
+    # the parse, so a PE parsed from bytes is simply dropped
+    return pe_feature_values(pefile.PE(data=bytes(data), fast_load=True))
+
+
+def path_feature_values(path):
+    """
+    Extract the Adobe features, in AdobeEval.ordered_features order, from the PE file at path. The whole file is
+    memory mapped and parsed, as pefile.PE(path) does, so that the features match the original path parsing exactly.
+    """
+    # The mapping is closed here rather than through PE.close(), which also runs a full gc.collect()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return pe_feature_values(pefile.PE(data=data, fast_load=True))
+
+
+def archive_headers(archive):
+    """
+    Yield (member name, header bytes) for every regular file of a zip or tar (optionally compressed) archive, given
+    as a path or, for tar, an open stream. Only the header region of each member is decompressed and the archive is
+    read in one sequential pass, without extracting anything.
+    """
+    if isinstance(archive, str) and zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in sorted(zf.infolist(), key=lambda info: info.header_offset):
+                if not info.is_dir():
+                    with zf.open(info) as member:
+                        yield info.filename, read_header(member)
+        return
+
+    stream = tarfile.open(archive, mode="r|*") if isinstance(archive, str) else tarfile.open(fileobj=archive,
+                                                                                             mode="r|*")
+    with stream as tf:
+        for member in tf:
+            if member.isfile():
+                yield member.name, read_header(tf.extractfile(member))
+
+
+def sample_path(samples_dir, sha256):
+    return f"{samples_dir}/{sha256[0]}/{sha256[1]}/{sha256[2]}/{sha256}"
+
+
+def pack_sample_headers(samples_dir, pack_path):
+    """
+    Pack the header region of every sample under samples_dir/{a}/{b}/{c}/{sha256} into the HeaderPack at pack_path.
+    Samples already in the pack are not read again, so rerunning this after new samples arrive appends only those.
+    """
+    packed = set(header_pack.HeaderPack(pack_path).sha256s()) if os.path.exists(pack_path + ".index.npz") else set()
+
+    def headers():
+        for path in sorted(glob.glob(f"{samples_dir}/*/*/*/*")):
+            sha256 = os.path.basename(path)
+            if sha256 not in packed:
+                with open(path, "rb") as f:
+                    yield sha256, read_header(f)
+
+    return header_pack.HeaderPack.append(pack_path, headers())
 
 
 class AdobeEval:
@@ -22,46 +156,37 @@ class AdobeEval:
     ]
     dim = len(ordered_features)
 
-    def __init__(self, path=None, raw_features=None):
-        if path is not None and raw_features is not None:
-            raise Exception("Cannot initialize with both a path and raw features.")
+    def __init__(self, path=None, raw_features=None, data=None):
+        if sum(source is not None for source in [path, raw_features, data]) > 1:
+            raise Exception("Cannot initialize with more than one of a path, raw features and data.")
 
         if path is not None:
             self.from_path(path)
         elif raw_features is not None:
             self.from_raw_features(raw_features)
+        elif data is not None:
+            self.from_buffer(data)
 
     def from_raw_features(self, raw_features):
         try:
-            self.DebugSize = raw_features["datadirectories"][6]["size"]
-            self.ImageVersion = ((raw_features["header"]["optional"]["major_image_version"] * 100 +
-                                  raw_features["header"]["optional"]["minor_image_version"]) * 1000)
-            self.IatRVA = raw_features["datadirectories"][1]["virtual_address"]
-            self.ExportSize = raw_features["datadirectories"][0]["size"]
-            self.ResourceSize = raw_features["datadirectories"][2]["size"]
-            self.NumberOfSections = len(raw_features["section"]["sections"])
-            if len(raw_features["section"]["sections"]) < 2:
-                self.VirtualSize2 = 0
-            else:
-                self.VirtualSize2 = raw_features["section"]["sections"][1]["vsize"]
+            values = raw_feature_values(raw_features)
+            self.__dict__.update(zip(self.ordered_features, values))
             self.init_success = True
         except Exception:
             self.init_success = False
 
     def from_path(self, path):
         try:
-            pef = pefile.PE(path, fast_load=True)
-            self.DebugSize = pef.OPTIONAL_HEADER.DATA_DIRECTORY[6].Size
-            self.ImageVersion = (
-                (pef.OPTIONAL_HEADER.MajorImageVersion * 100) + pef.OPTIONAL_HEADER.MinorImageVersion) * 1000
-            self.IatRVA = pef.OPTIONAL_HEADER.DATA_DIRECTORY[1].VirtualAddress
-            self.ExportSize = pef.OPTIONAL_HEADER.DATA_DIRECTORY[0].Size
-            self.ResourceSize = pef.OPTIONAL_HEADER.DATA_DIRECTORY[2].Size
-            self.NumberOfSections = pef.FILE_HEADER.NumberOfSections
-            if len(pef.sections) < 2:
-                self.VirtualSize2 = 0
-            else:
-                self.VirtualSize2 = pef.sections[1].Misc_VirtualSize
+            values = path_feature_values(path)
+            self.__dict__.update(zip(self.ordered_features, values))
+            self.init_success = True
+        except Exception:
+            self.init_success = False
+
+    def from_buffer(self, data):
+        try:
+            values = buffer_feature_values(data)
+            self.__dict__.update(zip(self.ordered_features, values))
             self.init_success = True
         except Exception:
             self.init_success = False
@@ -679,79 +804,1006 @@ class AdobeEval:
         return sum([self.J48, self.J48Graft, self.PART, self.Ridor]) / 4.0
 
 
+class RuleLeaf:
+    """
+    A terminal "isDirty = value" assignment of a compiled rule model. path is the list of (branch id, holds) steps that
+    lead to it from the root and lineno the line of the assignment in the AdobeEval source.
+    """
+
+    def __init__(self, value, index, path, lineno):
+        self.value = value
+        self.index = index
+        self.path = path
+        self.lineno = lineno
+
+
+class RuleNode:
+    """
+    An if/elif/else chain of a compiled rule model. Each branch is a list of (feature index, operator, threshold)
+    predicates that must all hold, and the child that is taken when they do. default is taken when no branch matches.
+    """
+
+    def __init__(self, branches, default):
+        self.branches = branches
+        self.default = default
+
+
+class RuleModel:
+    """
+    One of the AdobeEval rule models compiled from its source into a RuleNode tree that can be evaluated on a whole
+    (N, AdobeEval.dim) feature matrix at once. The tree is derived from the AdobeEval.run* method itself, so the two
+    can never drift apart.
+    """
+
+    operators = {ast.LtE: np.less_equal, ast.Lt: np.less, ast.GtE: np.greater_equal, ast.Gt: np.greater}
+    symbols = {ast.LtE: ("<=", ">"), ast.Lt: ("<", ">="), ast.GtE: (">=", "<"), ast.Gt: (">", "<=")}
+
+    def __init__(self, name, method):
+        self.name = name
+        self.leaves = []
+        self.branches = []
+        lines, self.first_lineno = inspect.getsourcelines(method)
+        function = ast.parse(textwrap.dedent("".join(lines))).body[0]
+        self.root = self._compile_block(function.body, 0, [], function.lineno)
+        self.leaf_values = np.array([leaf.value for leaf in self.leaves], dtype=np.int8)
+        self.rules = [self.rule(leaf.index) for leaf in self.leaves]
+
+    def _leaf(self, value, path, lineno):
+        self.leaves.append(RuleLeaf(value, len(self.leaves), path, self.first_lineno + lineno - 1))
+        return self.leaves[-1]
+
+    def _compile_block(self, statements, value, path, lineno):
+        child = None
+        for statement in statements:
+            if isinstance(statement, ast.Assign):
+                value = statement.value.value
+                lineno = statement.lineno
+            elif isinstance(statement, ast.If) and child is None:
+                child = self._compile_if(statement, value, path, lineno)
+            elif not isinstance(statement, ast.Return):
+                raise Exception(f"Unsupported statement in {self.name} at line {statement.lineno}")
+        return child if child is not None else self._leaf(value, path, lineno)
+
+    def _compile_if(self, statement, value, path, lineno):
+        branches = []
+        while True:
+            predicates = self._compile_test(statement.test)
+            branch_id = len(self.branches)
+            self.branches.append((predicates, self.first_lineno + statement.lineno - 1))
+            branches.append((predicates, self._compile_block(statement.body, value, path + [(branch_id, True)],
+                                                             lineno)))
+            path = path + [(branch_id, False)]
+            if len(statement.orelse) == 1 and isinstance(statement.orelse[0], ast.If):
+                statement = statement.orelse[0]
+            else:
+                break
+        # A chain without an else falls through with isDirty unchanged
+        return RuleNode(branches, self._compile_block(statement.orelse, value, path, lineno))
+
+    def _compile_test(self, test):
+        comparisons = test.values if isinstance(test, ast.BoolOp) and isinstance(test.op, ast.And) else [test]
+        predicates = []
+        for comparison in comparisons:
+            if (not isinstance(comparison, ast.Compare) or len(comparison.ops) != 1 or
+                    type(comparison.ops[0]) not in self.operators):
+                raise Exception(f"Unsupported test in {self.name} at line {comparison.lineno}")
+            feature = AdobeEval.ordered_features.index(comparison.left.attr)
+            predicates.append((feature, type(comparison.ops[0]), comparison.comparators[0].value))
+        return predicates
+
+    @classmethod
+    def _predicate_text(cls, feature, operator, threshold, holds=True):
+        return f"{AdobeEval.ordered_features[feature]} {cls.symbols[operator][0 if holds else 1]} {threshold}"
+
+    def branch_text(self, branch_id):
+        return " and ".join(self._predicate_text(*predicate) for predicate in self.branches[branch_id][0])
+
+    def rule(self, leaf_id):
+        """
+        Render the full predicate path to a leaf, e.g. "NumberOfSections <= 5 and not (DebugSize > 0 and ...) =>
+        isDirty = 1 (line 123)". Branches that had to fail to reach the leaf are negated.
+        """
+        leaf = self.leaves[leaf_id]
+        conditions = []
+        for branch_id, holds in leaf.path:
+            predicates = self.branches[branch_id][0]
+            if holds:
+                conditions += [self._predicate_text(*predicate) for predicate in predicates]
+            elif len(predicates) == 1:
+                conditions.append(self._predicate_text(*predicates[0], holds=False))
+            else:
+                conditions.append(f"not ({self.branch_text(branch_id)})")
+        return f"{' and '.join(conditions) or 'always'} => isDirty = {leaf.value} (line {leaf.lineno})"
+
+    def leaf_ids(self, X):
+        """
+        Return the index into self.leaves reached by every row of X
+        """
+        leaf_ids = np.empty(X.shape[0], dtype=np.int32)
+        self._route(self.root, X, np.arange(X.shape[0]), leaf_ids)
+        return leaf_ids
+
+    def _route(self, node, X, rows, leaf_ids):
+        if isinstance(node, RuleLeaf):
+            leaf_ids[rows] = node.index
+            return
+        for predicates, child in node.branches:
+            if len(rows) == 0:
+                return
+            taken = np.ones(len(rows), dtype=bool)
+            for feature, operator, threshold in predicates:
+                # Compare in float64 like AdobeEval does: NumPy would round an int threshold to the float32 of X
+                taken &= self.operators[operator](X[rows, feature], np.float64(threshold))
+            self._route(child, X, rows[taken], leaf_ids)
+            rows = rows[~taken]
+        if len(rows):
+            self._route(node.default, X, rows, leaf_ids)
+
+    def predict(self, X):
+        """
+        Return the 0/1 vote of this model for every row of X
+        """
+        return self.leaf_values[self.leaf_ids(X)]
+
+    def thresholds(self):
+        """
+        Return the set of thresholds each feature is compared against anywhere in this model
+        """
+        thresholds = [set() for _ in range(AdobeEval.dim)]
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, RuleLeaf):
+                continue
+            for predicates, child in node.branches:
+                for feature, _, threshold in predicates:
+                    thresholds[feature].add(threshold)
+                nodes.append(child)
+            nodes.append(node.default)
+        return thresholds
+
+
+class BinnedRuleEnsemble:
+    """
+    Evaluates several RuleModels on equivalence classes of rows instead of on every row. The models only compare each
+    feature against a finite set of thresholds, so two rows that fall on the same side of (or exactly on) every
+    threshold reach the same leaves. Rows are mapped to per-feature bin codes with searchsorted, each distinct bin tuple
+    is evaluated once and the leaves found are memoized across calls, so the cost of scoring grows with the number of
+    distinct bin tuples rather than the number of rows.
+    """
+
+    def __init__(self, models):
+        self.models = models
+        thresholds = [set() for _ in range(AdobeEval.dim)]
+        for model in models:
+            for feature, feature_thresholds in enumerate(model.thresholds()):
+                thresholds[feature] |= feature_thresholds
+        self.thresholds = [np.array(sorted(t), dtype=np.float64) for t in thresholds]
+
+        # Values below, equal to and between the k thresholds of a feature give 2k+1 bins. The bin codes of a row are
+        # packed into a single int64 key with a mixed radix.
+        radix = [2 * len(t) + 1 for t in self.thresholds]
+        if np.prod(radix, dtype=np.float64) >= 2**63:
+            raise Exception("Too many thresholds to pack bin codes into an int64 key")
+        self.place_values = np.cumprod([1] + radix[:0:-1], dtype=np.int64)[::-1]
+
+        self.memo_keys = np.empty(0, dtype=np.int64)
+        self.memo_leaf_ids = np.empty((0, len(models)), dtype=np.int32)
+
+    def bin_codes(self, X):
+        """
+        Return the (N, AdobeEval.dim) bin code of every feature of every row of X
+        """
+        codes = np.empty(X.shape, dtype=np.int64)
+        for feature, thresholds in enumerate(self.thresholds):
+            column = X[:, feature].astype(np.float64)
+            position = np.searchsorted(thresholds, column)
+            on_threshold = thresholds[np.minimum(position, len(thresholds) - 1)] == column
+            codes[:, feature] = 2 * position + on_threshold
+        return codes
+
+    def bin_keys(self, X):
+        """
+        Return a single int64 key per row of X identifying its bin tuple
+        """
+        return self.bin_codes(X) @ self.place_values
+
+    def leaf_ids(self, X):
+        """
+        Return the (N, len(models)) leaf index reached by every row of X in every model
+        """
+        keys, first, inverse = np.unique(self.bin_keys(X), return_index=True, return_inverse=True)
+
+        # Evaluate only the bin tuples not seen in earlier calls, using the first row of each as its representative
+        position = np.searchsorted(self.memo_keys, keys)
+        known = np.zeros(len(keys), dtype=bool)
+        in_range = position < len(self.memo_keys)
+        known[in_range] = self.memo_keys[position[in_range]] == keys[in_range]
+        if not known.all():
+            representatives = X[first[~known]]
+            new_leaf_ids = np.column_stack([model.leaf_ids(representatives) for model in self.models])
+            memo_keys = np.concatenate((self.memo_keys, keys[~known]))
+            order = np.argsort(memo_keys, kind="stable")
+            self.memo_keys = memo_keys[order]
+            self.memo_leaf_ids = np.concatenate((self.memo_leaf_ids, new_leaf_ids))[order]
+            position = np.searchsorted(self.memo_keys, keys)
+
+        return self.memo_leaf_ids[position][inverse.reshape(-1)]
+
+    def votes(self, leaf_ids):
+        """
+        Return the (N, len(models)) 0/1 votes of the leaves from leaf_ids
+        """
+        return np.column_stack([model.leaf_values[leaf_ids[:, i]] for i, model in enumerate(self.models)])
+
+    def predict(self, X):
+        """
+        Return the (N, len(models)) 0/1 votes of every model for every row of X
+        """
+        return self.votes(self.leaf_ids(X))
+
+
+_rule_models = None
+_rule_ensemble = None
+
+
+def rule_models():
+    """
+    The four AdobeEval rule models, in AdobeFeatureBatch.models order. They are compiled on first use so that importing
+    this module stays cheap.
+    """
+    global _rule_models
+    if _rule_models is None:
+        _rule_models = [RuleModel(name, getattr(AdobeEval, "run" + name)) for name in AdobeFeatureBatch.models]
+    return _rule_models
+
+
+def rule_table():
+    """
+    Map every model name to the list of its rendered rules, indexed by the leaf ids of AdobeFeatureBatch.leaves
+    """
+    return {model.name: model.rules for model in rule_models()}
+
+
+def rule_ensemble():
+    """
+    The process-wide BinnedRuleEnsemble over rule_models(), shared so that its memo keeps growing across batches
+    """
+    global _rule_ensemble
+    if _rule_ensemble is None:
+        _rule_ensemble = BinnedRuleEnsemble(rule_models())
+    return _rule_ensemble
+
+
+class AdobeFeatureBatch:
+    """
+    The Adobe features of many samples stored as arrays rather than one AdobeEval object per sample: a contiguous
+    (N, AdobeEval.dim) int64 feature matrix, a validity mask standing in for AdobeEval.init_success, an int8 vote
+    column per model and the int16 leaf of each model that produced the vote, which indexes rule_table(). Votes and
+    leaves are -1 until predict is called, and for invalid rows.
+    """
+
+    models = ["J48", "J48Graft", "PART", "Ridor"]
+
+    def __init__(self, nrows):
+        self.X = np.zeros((nrows, AdobeEval.dim), dtype=np.int64)
+        self.valid = np.zeros(nrows, dtype=bool)
+        self.votes = np.full((nrows, len(self.models)), -1, dtype=np.int8)
+        self.leaves = np.full((nrows, len(self.models)), -1, dtype=np.int16)
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def resize(self, nrows):
+        self.X = np.resize(self.X, (nrows, AdobeEval.dim))
+        self.valid = np.resize(self.valid, nrows)
+        self.votes = np.resize(self.votes, (nrows, len(self.models)))
+        self.leaves = np.resize(self.leaves, (nrows, len(self.models)))
+
+    def set_raw_features(self, irow, raw_features):
+        try:
+            self.X[irow] = raw_feature_values(raw_features)
+            self.valid[irow] = True
+        except Exception:
+            self.X[irow] = 0
+            self.valid[irow] = False
+        return self.valid[irow]
+
+    def set_path(self, irow, path):
+        try:
+            self.X[irow] = path_feature_values(path)
+            self.valid[irow] = True
+        except Exception:
+            self.X[irow] = 0
+            self.valid[irow] = False
+        return self.valid[irow]
+
+    def set_buffer(self, irow, data):
+        try:
+            self.X[irow] = buffer_feature_values(data)
+            self.valid[irow] = True
+        except Exception:
+            self.X[irow] = 0
+            self.valid[irow] = False
+        return self.valid[irow]
+
+    @classmethod
+    def _fill(cls, setter, items, nrows):
+        if nrows is None and hasattr(items, "__len__"):
+            nrows = len(items)
+        batch = cls(nrows if nrows is not None else 1024)
+        irow = -1
+        for irow, item in enumerate(items):
+            if irow >= len(batch):
+                batch.resize(2 * len(batch))
+            setter(batch, irow, item)
+        if irow + 1 != len(batch):
+            batch.resize(irow + 1)
+        return batch
+
+    @classmethod
+    def from_raw_features(cls, raw_features, nrows=None):
+        """
+        Fill a batch from an iterable of EMBER raw features dictionaries
+        """
+        return cls._fill(cls.set_raw_features, raw_features, nrows)
+
+    @classmethod
+    def from_paths(cls, paths, nrows=None):
+        """
+        Fill a batch by parsing the headers of an iterable of PE file paths
+        """
+        return cls._fill(cls.set_path, paths, nrows)
+
+    @classmethod
+    def from_buffers(cls, buffers, nrows=None):
+        """
+        Fill a batch from an iterable of the bytes of PE files, or of just their header regions
+        """
+        return cls._fill(cls.set_buffer, buffers, nrows)
+
+    @classmethod
+    def from_pack(cls, pack, sha256s=None):
+        """
+        Fill a batch from the headers of a HeaderPack, for the given sha256s or for every sample in blob order. Returns
+        the batch and the sha256 of each row.
+        """
+        if sha256s is None:
+            sha256s = []
+
+            def buffers():
+                for sha256, header in pack.items():
+                    sha256s.append(sha256)
+                    yield header
+
+            return cls.from_buffers(buffers(), len(pack)), sha256s
+        return cls.from_buffers((pack.get(sha256) or b"" for sha256 in sha256s), len(sha256s)), list(sha256s)
+
+    @classmethod
+    def from_matrix(cls, X, valid=None):
+        """
+        Wrap an existing feature matrix, such as the output of read_vectorized_features. Rows of all zeros are what
+        AdobeEval.feature_vector writes for unparseable samples, so they are marked invalid unless valid is given.
+        """
+        batch = cls(0)
+        batch.X = np.ascontiguousarray(X, dtype=np.int64)
+        batch.valid = np.asarray(valid, dtype=bool) if valid is not None else batch.X.any(axis=1)
+        batch.votes = np.full((len(batch.X), len(cls.models)), -1, dtype=np.int8)
+        batch.leaves = np.full((len(batch.X), len(cls.models)), -1, dtype=np.int16)
+        return batch
+
+    def feature_vectors(self):
+        """
+        Return the float32 feature matrix in the format of AdobeEval.feature_vector
+        """
+        return np.where(self.valid[:, None], self.X, 0).astype(np.float32)
+
+    def predict(self, binned=True):
+        """
+        Fill the vote and leaf columns and return the fraction of models voting malicious for every row. Invalid rows
+        are classified malicious, as in AdobeEval.predict. With binned=True rows are scored once per distinct threshold
+        bin tuple through rule_ensemble(), otherwise every row is routed through every model.
+        """
+        rows = np.flatnonzero(self.valid)
+        X = self.X[rows]
+        if binned:
+            leaf_ids = rule_ensemble().leaf_ids(X)
+        else:
+            leaf_ids = np.column_stack([model.leaf_ids(X) for model in rule_models()])
+        self.leaves[rows] = leaf_ids
+        self.votes[rows] = rule_ensemble().votes(leaf_ids) if len(rows) else 0
+        y_pred = np.ones(len(self), dtype=np.float64)
+        y_pred[rows] = self.votes[rows].sum(axis=1) / len(self.models)
+        return y_pred
+
+    def explain(self, irow):
+        """
+        Return the rule each model applied to row irow, after predict, or None for an invalid row
+        """
+        if self.leaves[irow, 0] < 0:
+            return None
+        return {model.name: model.rules[leaf_id] for model, leaf_id in zip(rule_models(), self.leaves[irow])}
+
+
+class RuleCoverage:
+    """
+    Hit counts of every leaf of every rule model by label (unlabeled, benign, malicious), accumulated over batch
+    scoring runs. The rows that test and take each if/elif branch follow from the leaf counts and the leaf paths, so
+    profiling costs one bincount per model and batch. Coverages of different workers are merged with +=.
+    """
+
+    labels = ["unlabeled", "benign", "malicious"]
+
+    def __init__(self):
+        self.leaf_counts = [np.zeros((len(model.leaves), len(self.labels)), dtype=np.int64) for model in rule_models()]
+        self.invalid_counts = np.zeros(len(self.labels), dtype=np.int64)
+
+    def update(self, batch, y=None):
+        """
+        Add the leaves of a predicted AdobeFeatureBatch, with labels y (-1 unlabeled, 0 benign, 1 malicious)
+        """
+        label = np.full(len(batch), -1, dtype=np.int64) if y is None else np.asarray(y, dtype=np.int64)
+        valid = batch.valid
+        self.invalid_counts += np.bincount(label[~valid] + 1, minlength=len(self.labels))
+        for imodel, counts in enumerate(self.leaf_counts):
+            cells = batch.leaves[valid, imodel].astype(np.int64) * len(self.labels) + label[valid] + 1
+            counts += np.bincount(cells, minlength=counts.size).reshape(counts.shape)
+        return self
+
+    def __iadd__(self, other):
+        for counts, other_counts in zip(self.leaf_counts, other.leaf_counts):
+            counts += other_counts
+        self.invalid_counts += other.invalid_counts
+        return self
+
+    def branch_counts(self, imodel):
+        """
+        Return the (nbranches, 2, 3) counts by label of the rows that tested and that took every branch of a model
+        """
+        model = rule_models()[imodel]
+        counts = np.zeros((len(model.branches), 2, len(self.labels)), dtype=np.int64)
+        for leaf, leaf_counts in zip(model.leaves, self.leaf_counts[imodel]):
+            for branch_id, holds in leaf.path:
+                counts[branch_id, 0] += leaf_counts
+                if holds:
+                    counts[branch_id, 1] += leaf_counts
+        return counts
+
+    def report(self, path):
+        """
+        Write a tab separated coverage report with one row per branch and per leaf of every model. Branch rows give the
+        rows that tested and took the branch, leaf rows the rows that ended there and how many of the labeled ones
+        the leaf's vote got wrong.
+        """
+        header = ["model", "kind", "id", "line", "tested", "hits"] + self.labels + ["errors", "error_rate", "rule"]
+        with open(path, "w") as f:
+            f.write("\t".join(header) + "\n")
+            for imodel, model in enumerate(rule_models()):
+                for branch_id, (tested, taken) in enumerate(self.branch_counts(imodel)):
+                    row = [model.name, "branch", branch_id, model.branches[branch_id][1], tested.sum(), taken.sum()]
+                    row += list(taken) + ["", "", model.branch_text(branch_id)]
+                    f.write("\t".join(map(str, row)) + "\n")
+                for leaf, counts in zip(model.leaves, self.leaf_counts[imodel]):
+                    errors = counts[1 + (1 - leaf.value)]
+                    labeled = counts[1] + counts[2]
+                    error_rate = f"{errors / labeled:.6f}" if labeled else ""
+                    row = [model.name, "leaf", leaf.index, leaf.lineno, "", counts.sum()]
+                    row += list(counts) + [errors, error_rate, model.rules[leaf.index]]
+                    f.write("\t".join(map(str, row)) + "\n")
+
+
+def rule_coverage_chunk(data_dir, subset, start, stop):
+    """
+    Score rows start to stop of a subset of the vectorized features and return their RuleCoverage
+    """
+    X, y = read_vectorized_features(data_dir, subset)
+    batch = AdobeFeatureBatch.from_matrix(X[start:stop])
+    batch.predict()
+    return RuleCoverage().update(batch, y[start:stop])
+
+
+def rule_coverage_chunk_unpack(args):
+    """
+    Pass through function for unpacking rule_coverage_chunk arguments
+    """
+    return rule_coverage_chunk(*args)
+
+
+def profile_rule_coverage(data_dir, subset="train", chunk_rows=1 << 18, processes=None):
+    """
+    Score a subset of the vectorized Adobe features in chunks across a pool of workers, merge the coverage of every
+    worker and write it to data_dir/rule_coverage_<subset>.tsv
+    """
+    _, y = read_vectorized_features(data_dir, subset)
+    arguments = [(data_dir, subset, start, stop) for start, stop in feature_store.chunk_ranges(len(y), chunk_rows)]
+    coverage = RuleCoverage()
+    with multiprocessing.Pool(processes) as pool:
+        for chunk_coverage in pool.imap_unordered(rule_coverage_chunk_unpack, arguments):
+            coverage += chunk_coverage
+    coverage.report(os.path.join(data_dir, f"rule_coverage_{subset}.tsv"))
+    return coverage
+
+
+def call_rule(function, *args):
+    """
+    Return the vote of a per-row rule implementation, or -1 if it raised
+    """
+    try:
+        return function(*args)
+    except Exception:
+        return -1
+
+
+def legacy_rule_votes(X):
+    """
+    Return the (N, 4) votes of the rule functions of AdobeMalwareClassifier.py for the rows of X, -1 where they raised
+    """
+    import types
+    import AdobeMalwareClassifier
+
+    functions = dict(AdobeMalwareClassifier.MODELS.values())
+    functions = [functions[name] for name in AdobeFeatureBatch.models]
+    votes = np.empty((len(X), len(functions)), dtype=np.int8)
+    for irow, row in enumerate(np.asarray(X).tolist()):
+        pef = types.SimpleNamespace(**dict(zip(AdobeEval.ordered_features, row)))
+        votes[irow] = [call_rule(function, pef) for function in functions]
+    return votes
+
+
+def eval_rule_votes(X):
+    """
+    Return the (N, 4) votes of the AdobeEval.run* methods for the rows of X, -1 where they raised
+    """
+    adobe_eval = AdobeEval()
+    methods = [getattr(adobe_eval, "run" + name) for name in AdobeFeatureBatch.models]
+    votes = np.empty((len(X), len(methods)), dtype=np.int8)
+    for irow, row in enumerate(np.asarray(X).tolist()):
+        adobe_eval.__dict__.update(zip(AdobeEval.ordered_features, row))
+        votes[irow] = [call_rule(method) for method in methods]
+    return votes
+
+
+def routed_rule_votes(X):
+    """
+    Return the (N, 4) votes of the compiled RuleModels, routing every row through every model
+    """
+    return np.column_stack([model.predict(X) for model in rule_models()])
+
+
+def binned_rule_votes(X):
+    """
+    Return the (N, 4) votes of a fresh BinnedRuleEnsemble, so that every chunk pays for its own bin tuples
+    """
+    return BinnedRuleEnsemble(rule_models()).predict(X)
+
+
+# Every implementation of the rule models, by name. An engine maps an (N, AdobeEval.dim) matrix to (N, 4) votes in
+# AdobeFeatureBatch.models order; a new fast path is added here to be held to the others by check_rule_parity.
+rule_engines = {
+    "legacy": legacy_rule_votes,
+    "eval": eval_rule_votes,
+    "routed": routed_rule_votes,
+    "binned": binned_rule_votes
+}
+
+
+def threshold_corpus(nrows, seed=0):
+    """
+    Return nrows random feature vectors whose values are drawn from every threshold of the rule models, one below and
+    one above it, and zero. Real samples rarely land exactly on a threshold, which is where implementations that
+    disagree about < versus <= part ways.
+    """
+    rng = np.random.default_rng(seed)
+    X = np.empty((nrows, AdobeEval.dim), dtype=np.float32)
+    for feature, thresholds in enumerate(rule_ensemble().thresholds):
+        values = np.unique(np.concatenate(([0], thresholds, np.floor(thresholds) - 1, np.floor(thresholds) + 1)))
+        X[:, feature] = rng.choice(values[values >= 0], nrows)
+    return X
+
+
+def rule_parity_chunk(X, start, engines, reference):
+    """
+    Score the rows X of a chunk starting at row start with every engine and return the seconds each engine took and
+    the (row, model index, features, votes by engine) of every vote on which an engine differs from the reference
+    """
+    import time
+
+    seconds = {}
+    votes = {}
+    for name in engines:
+        begin = time.perf_counter()
+        votes[name] = rule_engines[name](X)
+        seconds[name] = time.perf_counter() - begin
+
+    differs = np.zeros(votes[reference].shape, dtype=bool)
+    for name in engines:
+        differs |= votes[name] != votes[reference]
+    mismatches = [(start + int(irow), int(imodel), X[irow].tolist(),
+                   {name: int(votes[name][irow, imodel]) for name in engines})
+                  for irow, imodel in zip(*np.nonzero(differs))]
+    return seconds, mismatches
+
+
+def rule_parity_chunk_unpack(args):
+    """
+    Pass through function for unpacking rule_parity_chunk arguments
+    """
+    return rule_parity_chunk(*args)
+
+
+def check_rule_parity(X, engines=None, reference="legacy", chunk_rows=1 << 14, processes=None):
+    """
+    Score the rows of X with every engine of rule_engines across a pool of workers and compare their votes with the
+    reference engine. Return a dictionary with the total seconds and speedup over the reference of every engine, the
+    number of mismatching votes by engine and model, and every mismatch as (row, model, features, votes by engine).
+    """
+    engines = list(rule_engines) if engines is None else list(engines)
+    if reference not in engines:
+        engines.insert(0, reference)
+    rule_models()
+
+    arguments = [(np.asarray(X[start:stop], dtype=np.float32), start, engines, reference)
+                 for start, stop in feature_store.chunk_ranges(len(X), chunk_rows)]
+    seconds = dict.fromkeys(engines, 0.0)
+    counts = {name: dict.fromkeys(AdobeFeatureBatch.models, 0) for name in engines}
+    mismatches = []
+    with multiprocessing.Pool(processes) as pool:
+        for chunk_seconds, chunk_mismatches in pool.imap_unordered(rule_parity_chunk_unpack, arguments):
+            for name in engines:
+                seconds[name] += chunk_seconds[name]
+            for row, imodel, features, votes in chunk_mismatches:
+                model = AdobeFeatureBatch.models[imodel]
+                for name in engines:
+                    counts[name][model] += votes[name] != votes[reference]
+                mismatches.append((row, model, features, votes))
+
+    mismatches.sort(key=lambda mismatch: mismatch[:2])
+    return {
+        "rows": len(X),
+        "seconds": seconds,
+        "speedup": {name: seconds[reference] / max(seconds[name], 1e-12) for name in engines},
+        "mismatch_counts": counts,
+        "mismatches": mismatches
+    }
+
+
+def write_rule_parity_report(parity, path):
+    """
+    Write the engine timings and every mismatching vote of a check_rule_parity result to a tab separated file
+    """
+    engines = list(parity["seconds"])
+    with open(path, "w") as f:
+        f.write("\t".join(["engine", "seconds", "rows_per_second", "speedup"] + AdobeFeatureBatch.models) + "\n")
+        for name in engines:
+            seconds = parity["seconds"][name]
+            counts = [parity["mismatch_counts"][name][model] for model in AdobeFeatureBatch.models]
+            rows_per_second = parity["rows"] / max(seconds, 1e-12)
+            row = [name, f"{seconds:.3f}", f"{rows_per_second:.0f}", f"{parity['speedup'][name]:.1f}"]
+            f.write("\t".join(map(str, row + counts)) + "\n")
+        f.write("\n" + "\t".join(["row", "model"] + AdobeEval.ordered_features + engines) + "\n")
+        for row, model, features, votes in parity["mismatches"]:
+            row = [row, model] + [f"{value:g}" for value in features] + [votes[name] for name in engines]
+            f.write("\t".join(map(str, row)) + "\n")
+
+
+def rule_parity_report(data_dir, subset="test", threshold_rows=1 << 16, processes=None):
+    """
+    Check every rule engine against the legacy classifier on a subset of the vectorized Adobe features and on a
+    threshold_corpus, write both reports to data_dir/rule_parity_<corpus>.tsv and return the two results
+    """
+    X, _ = read_vectorized_features(data_dir, subset)
+    results = {}
+    for corpus, X_corpus in [(subset, X), ("thresholds", threshold_corpus(threshold_rows))]:
+        results[corpus] = check_rule_parity(X_corpus, processes=processes)
+        write_rule_parity_report(results[corpus], os.path.join(data_dir, f"rule_parity_{corpus}.tsv"))
+        speedups = ", ".join(f"{name} {speedup:.1f}x" for name, speedup in results[corpus]["speedup"].items())
+        print(f"{corpus}: {len(results[corpus]['mismatches'])} mismatching votes; speedup over legacy: {speedups}")
+    return results
+
+
 class AdobeModel:
 
     def __init__(self):
         return
 
     def predict_raw_features(self, raw_features):
-        y_pred = []
-        for raw_feature_dict in raw_features:
-            y_pred.append(AdobeEval(raw_features=raw_feature_dict).predict())
-        return y_pred
+        return AdobeFeatureBatch.from_raw_features(raw_features).predict()
 
     def predict_paths(self, paths):
-        y_pred = []
-        for path in paths:
-            y_pred.append(AdobeEval(path=path).predict())
-        return y_pred
+        return AdobeFeatureBatch.from_paths(paths).predict()
+
+    def predict_buffers(self, buffers):
+        return AdobeFeatureBatch.from_buffers(buffers).predict()
+
+    def predict_archive(self, archive):
+        """
+        Score every file of a zip or tar archive in one pass over it and return the member names and predictions
+        """
+        names = []
+
+        def buffers():
+            for name, data in archive_headers(archive):
+                names.append(name)
+                yield data
+
+        y_pred = self.predict_buffers(buffers())
+        return names, y_pred
 
 
-def vectorize(irow, raw_features_string, X_path, y_path, nrows):
+def cascade_scores(adobe_pred, adobe_valid, ember_pred, low, high):
     """
-    Vectorize a single sample of raw features and write to a large numpy file
+    Return the (scores, forwarded) of a cascade: samples whose Adobe vote fraction is at or below low are scored 0,
+    at or above high 1, and the rest, as well as samples whose headers could not be parsed, are forwarded and get
+    their EMBER score. Thresholding the scores gives the cascade verdicts.
     """
-    raw_features = json.loads(raw_features_string)
-    feature_vector = AdobeEval(raw_features=raw_features).feature_vector()
+    forwarded = ~adobe_valid | ((adobe_pred > low) & (adobe_pred < high))
+    scores = np.where(adobe_pred >= high, 1.0, 0.0)
+    scores[forwarded] = ember_pred[forwarded]
+    return scores, forwarded
 
-    y = np.memmap(y_path, dtype=np.float32, mode="r+", shape=nrows)
-    y[irow] = raw_features["label"]
 
-    X = np.memmap(X_path, dtype=np.float32, mode="r+", shape=(nrows, AdobeEval.dim))
-    X[irow] = feature_vector
+def threshold_at_fpr(benign_scores, fpr_target):
+    """
+    Return the lowest threshold at which at most fpr_target of benign_scores are at or above it
+    """
+    scores = np.sort(np.asarray(benign_scores))[::-1]
+    allowed = int(np.floor(fpr_target * len(scores)))
+    if allowed >= len(scores):
+        return 0.0
+    return float(np.nextafter(scores[allowed], np.inf))
 
 
-def vectorize_unpack(args):
+def calibrate_cascade(data_dir, fpr_target=1e-3, max_tpr_loss=1e-3):
+    """
+    Choose the uncertain band of a cascade of the Adobe rules and the benchmark EMBER model on the test set. Every
+    band of Adobe vote fractions is scored end to end at the threshold that keeps the test FPR at fpr_target, and the
+    band that forwards the fewest samples while losing at most max_tpr_loss TPR against the EMBER model alone is
+    written to data_dir/cascade.json. All bands are listed in data_dir/cascade_calibration.tsv.
+
+    The Adobe features are those vectorized from the EMBER raw features; scoring files reads them from the PE headers
+    with pefile, which can differ for some samples (see find_disagreements).
     """
-    Pass through function for unpacking vectorize arguments
+    import ember
+    import batch_predict
+
+    model_file = os.path.join(data_dir, "ember_model_2018.txt")
+    X_adobe, y_test = read_vectorized_features(data_dir, "test")
+    batch = AdobeFeatureBatch.from_matrix(X_adobe)
+    adobe_pred = batch.predict()
+    X_ember, _ = ember.read_vectorized_features(data_dir, "test")
+    ember_pred = batch_predict.predict_to_memmap(model_file, X_ember,
+                                                 os.path.join(data_dir, "y_test_pred_ember_model_2018.dat"))
+
+    labeled = np.asarray(y_test) != -1
+    y = np.asarray(y_test)[labeled]
+    adobe_pred, adobe_valid, ember_pred = adobe_pred[labeled], batch.valid[labeled], np.asarray(ember_pred)[labeled]
+
+    def evaluate(scores):
+        threshold = threshold_at_fpr(scores[y == 0], fpr_target)
+        return threshold, float(np.mean(scores[y == 0] >= threshold)), float(np.mean(scores[y == 1] >= threshold))
+
+    ember_threshold, ember_fpr, ember_tpr = evaluate(ember_pred)
+    fractions = [i / len(AdobeFeatureBatch.models) for i in range(len(AdobeFeatureBatch.models) + 1)]
+    bands = []
+    for low in [-1.0] + fractions[:-1]:
+        for high in [f for f in fractions[1:] if f > low] + [2.0]:
+            scores, forwarded = cascade_scores(adobe_pred, adobe_valid, ember_pred, low, high)
+            threshold, fpr, tpr = evaluate(scores)
+            bands.append({"low": low, "high": high, "threshold": threshold, "fpr": fpr, "tpr": tpr,
+                          "forwarded": float(forwarded.mean()), "tpr_change": tpr - ember_tpr})
+
+    # Bands that short-circuit more benign samples to malicious than the target FPR allows detect nothing
+    eligible = [band for band in bands if band["fpr"] <= fpr_target and band["tpr_change"] >= -max_tpr_loss]
+    best = min(eligible, key=lambda band: (band["forwarded"], -band["tpr"]))
+    cascade = dict(best, fpr_target=fpr_target, model_file=model_file, ember_threshold=ember_threshold,
+                   ember_fpr=ember_fpr, ember_tpr=ember_tpr)
+    json.dump(cascade, open(os.path.join(data_dir, "cascade.json"), "w"), indent=2)
+
+    columns = ["low", "high", "threshold", "fpr", "tpr", "tpr_change", "forwarded"]
+    with open(os.path.join(data_dir, "cascade_calibration.tsv"), "w") as f:
+        f.write("\t".join(columns + ["chosen"]) + "\n")
+        for band in bands:
+            f.write("\t".join([f"{band[c]:.6g}" for c in columns] + [str(band is best)]) + "\n")
+    print(f"EMBER alone at FPR {ember_fpr:.4%}: TPR {ember_tpr:.4%}")
+    print(f"Cascade forwarding Adobe scores in ({best['low']}, {best['high']}) at FPR {best['fpr']:.4%}: TPR "
+          f"{best['tpr']:.4%} ({best['tpr_change']:+.4%}), {1 - best['forwarded']:.2%} of samples short-circuited")
+    return cascade
+
+
+class CascadeScorer:
+    """
+    Scores PE files with the Adobe rules from their headers and runs full EMBER feature extraction and the benchmark
+    model only for the samples in the uncertain band chosen by calibrate_cascade. Counts of scored and forwarded
+    samples are kept across calls.
     """
-    return vectorize(*args)
 
+    def __init__(self, data_dir=None, low=0.0, high=1.0, threshold=0.5, model_file=None):
+        if data_dir is not None:
+            cascade = json.load(open(os.path.join(data_dir, "cascade.json")))
+            low, high, threshold = cascade["low"], cascade["high"], cascade["threshold"]
+            model_file = model_file or cascade["model_file"]
+        self.low = low
+        self.high = high
+        self.threshold = threshold
+        self.model_file = model_file
+        self.extractor = None
+        self.nscored = 0
+        self.nforwarded = 0
+
+    @property
+    def short_circuit_fraction(self):
+        return 1 - self.nforwarded / max(self.nscored, 1)
+
+    def ember_scores(self, paths):
+        """
+        Return the benchmark model's scores for the full contents of paths. Files EMBER cannot parse score 1.0, like
+        unexpectedly formed files in AdobeEval.predict.
+        """
+        import ember
+        import model_registry
+
+        if self.extractor is None:
+            self.extractor = ember.PEFeatureExtractor(2)
+        scores = np.ones(len(paths))
+        features = []
+        parsed = []
+        for i, path in enumerate(paths):
+            try:
+                features.append(self.extractor.feature_vector(open(path, "rb").read()))
+                parsed.append(i)
+            except Exception:
+                pass
+        if parsed:
+            scores[parsed] = model_registry.load_booster(self.model_file).predict(np.array(features))
+        return scores
 
-def vectorize_subset(X_path, y_path, raw_feature_paths, nrows):
+    def predict_paths(self, paths):
+        """
+        Return the cascade scores of paths and whether each sample was forwarded to the EMBER model. A sample is
+        detected when its score is at or above self.threshold.
+        """
+        paths = list(paths)
+        batch = AdobeFeatureBatch.from_paths(paths)
+        adobe_pred = batch.predict()
+        forwarded = ~batch.valid | ((adobe_pred > self.low) & (adobe_pred < self.high))
+        ember_pred = np.zeros(len(paths))
+        if forwarded.any():
+            ember_pred[forwarded] = self.ember_scores([paths[i] for i in np.flatnonzero(forwarded)])
+        scores, forwarded = cascade_scores(adobe_pred, batch.valid, ember_pred, self.low, self.high)
+        self.nscored += len(paths)
+        self.nforwarded += int(forwarded.sum())
+        return scores, forwarded
+
+
+class AdobeFeatureSet:
     """
-    Vectorize a subset of data and write it to disk
+    The Adobe features of AdobeEval, written to X_<subset>_adobe.dat and y_<subset>_adobe.dat
     """
-    # Create space on disk to write features to
-    X = np.memmap(X_path, dtype=np.float32, mode="w+", shape=(nrows, AdobeEval.dim))
-    y = np.memmap(y_path, dtype=np.float32, mode="w+", shape=nrows)
-    del X, y
 
-    # Distribute the vectorization work
-    pool = multiprocessing.Pool()
-    argument_iterator = ((irow, raw_features_string, X_path, y_path, nrows)
-                         for irow, raw_features_string in enumerate(ember.raw_feature_iterator(raw_feature_paths)))
-    for _ in tqdm.tqdm(pool.imap_unordered(vectorize_unpack, argument_iterator), total=nrows):
-        pass
+    name = "adobe"
+
+    def __init__(self):
+        self.dim = AdobeEval.dim
+
+    def paths(self, data_dir, subset):
+        return os.path.join(data_dir, f"X_{subset}_adobe.dat"), os.path.join(data_dir, f"y_{subset}_adobe.dat")
+
+    def feature_vector(self, raw_features):
+        return AdobeEval(raw_features=raw_features).feature_vector()
 
 
-def create_vectorized_features(data_dir):
+class EmberFeatureSet:
     """
-    Create feature vectors from raw features and write them to disk
+    The EMBER features of ember.PEFeatureExtractor, written to the X_<subset>.dat and y_<subset>.dat that
+    ember.read_vectorized_features reads
     """
-    print("Vectorizing training set")
-    X_path = os.path.join(data_dir, "X_train_adobe.dat")
-    y_path = os.path.join(data_dir, "y_train_adobe.dat")
-    raw_feature_paths = [os.path.join(data_dir, "train_features_{}.jsonl".format(i)) for i in range(6)]
-    nrows = sum([1 for fp in raw_feature_paths for line in open(fp)])
-    vectorize_subset(X_path, y_path, raw_feature_paths, nrows)
 
-    print("Vectorizing test set")
-    X_path = os.path.join(data_dir, "X_test_adobe.dat")
-    y_path = os.path.join(data_dir, "y_test_adobe.dat")
-    raw_feature_paths = [os.path.join(data_dir, "test_features.jsonl")]
-    nrows = sum([1 for fp in raw_feature_paths for line in open(fp)])
-    vectorize_subset(X_path, y_path, raw_feature_paths, nrows)
+    name = "ember"
+
+    def __init__(self, feature_version=2):
+        import ember
+        self.extractor = ember.PEFeatureExtractor(feature_version)
+        self.dim = self.extractor.dim
+
+    def paths(self, data_dir, subset):
+        return os.path.join(data_dir, f"X_{subset}.dat"), os.path.join(data_dir, f"y_{subset}.dat")
+
+    def feature_vector(self, raw_features):
+        return self.extractor.process_raw_features(raw_features)
+
+
+feature_sets = {"adobe": AdobeFeatureSet, "ember": EmberFeatureSet}
+
+
+def vectorize_lines(outputs, nrows, first_row, lines):
+    """
+    Decode each raw feature line once and write its row, starting at first_row, to every output. outputs is a list of
+    (feature set name, X_path, y_path). Returns the number of lines written.
+    """
+    extractors = [feature_sets[name]() for name, _, _ in outputs]
+    matrices = [(np.memmap(X_path, dtype=np.float32, mode="r+", shape=(nrows, extractor.dim)),
+                 np.memmap(y_path, dtype=np.float32, mode="r+", shape=nrows))
+                for extractor, (_, X_path, y_path) in zip(extractors, outputs)]
+    nlines = 0
+    for irow, line in enumerate(lines, first_row):
+        raw_features = json.loads(line)
+        for extractor, (X, y) in zip(extractors, matrices):
+            X[irow] = extractor.feature_vector(raw_features)
+            y[irow] = raw_features["label"]
+        nlines += 1
+    for X, y in matrices:
+        X.flush()
+        y.flush()
+    return nlines
+
+
+def vectorize_lines_unpack(args):
+    """
+    Pass through function for unpacking vectorize_lines arguments
+    """
+    return vectorize_lines(*args)
+
+
+def vectorize_shard(outputs, nrows, raw_feature_path, start, stop, first_row):
+    """
+    Vectorize lines start to stop of one raw feature file, which are rows first_row onwards, into every output
+    """
+    return vectorize_lines(outputs, nrows, first_row, raw_feature_io.iter_lines(raw_feature_path, start, stop))
+
+
+def vectorize_shard_unpack(args):
+    """
+    Pass through function for unpacking vectorize_shard arguments
+    """
+    return vectorize_shard(*args)
+
+
+def vectorize_subset(outputs, raw_feature_paths, nrows):
+    """
+    Vectorize a subset of data into every (feature set name, X_path, y_path) of outputs in one pass, decoding each
+    line once. The raw feature files can be plain or compressed. When their index has enough entry points every
+    worker decompresses, parses and writes its own shard of rows. Otherwise, as for a compressed file that is a single
+    frame, the lines are decompressed in a background thread here and handed to the workers in blocks.
+    """
+    import tqdm
+
+    # Create space on disk to write features to
+    for name, X_path, y_path in outputs:
+        X = np.memmap(X_path, dtype=np.float32, mode="w+", shape=(nrows, feature_sets[name]().dim))
+        y = np.memmap(y_path, dtype=np.float32, mode="w+", shape=nrows)
+        del X, y
+
+    # Distribute the vectorization work
+    pool = multiprocessing.Pool()
+    shards = raw_feature_io.shards(raw_feature_paths, 4 * multiprocessing.cpu_count())
+    if len(shards) >= multiprocessing.cpu_count():
+        argument_iterator = ((outputs, nrows) + shard for shard in shards)
+        function = vectorize_shard_unpack
+    else:
+        lines = raw_feature_io.raw_feature_iterator(raw_feature_paths)
+        blocks = iter(lambda: [line for _, line in zip(range(1024), lines)], [])
+        argument_iterator = ((outputs, nrows, 1024 * iblock, block) for iblock, block in enumerate(blocks))
+        function = vectorize_lines_unpack
+    with tqdm.tqdm(total=nrows) as progress:
+        for nlines in pool.imap_unordered(function, argument_iterator):
+            progress.update(nlines)
+
+
+def create_vectorized_features(data_dir, feature_set_names=("adobe", )):
+    """
+    Create feature vectors from raw features and write them to disk. Each raw feature file can also be a gzip (.gz)
+    or zstd (.zst) compressed copy. With feature_set_names=("adobe", "ember") the Adobe and EMBER matrices are both
+    written in the same pass over the raw features, replacing a separate ember.create_vectorized_features run.
+    """
+    raw_feature_paths = {
+        "train": [os.path.join(data_dir, "train_features_{}.jsonl".format(i)) for i in range(6)],
+        "test": [os.path.join(data_dir, "test_features.jsonl")],
+    }
+    for subset in ["train", "test"]:
+        print(f"Vectorizing {subset} set")
+        paths = [raw_feature_io.find_raw_feature_path(path) for path in raw_feature_paths[subset]]
+        outputs = [(name, ) + feature_sets[name]().paths(data_dir, subset) for name in feature_set_names]
+        vectorize_subset(outputs, paths, raw_feature_io.count_lines(paths))
 
 
 def read_vectorized_features(data_dir, subset=None):
@@ -788,23 +1840,89 @@ def read_vectorized_features(data_dir, subset=None):
     return X_train, y_train, X_test, y_test
 
 
-def optimize_model(data_dir):
+def successive_halving_search(X, y, param_grid, folds, eta=3, min_data_fraction=0.1, max_fpr=5e-3):
+    """
+    Successive halving over boosting rounds and training data fractions, as a cheaper alternative to GridSearchCV.
+    Every candidate starts with a few rounds on the most recent part of each fold's training window. After each rung
+    only the best 1/eta of the candidates by mean partial AUC are kept, and the survivors are retrained with eta times
+    more rounds and data, until the last rung trains on all the data for max(param_grid["num_iterations"]) rounds.
+    The num_iterations values are scored at the last rung from the same boosters. Returns the best parameters in the
+    format of GridSearchCV.best_params_.
     """
-    Run a grid search to find the best LightGBM parameters
+    import lightgbm as lgb
+    from sklearn.metrics import roc_auc_score
+    from sklearn.model_selection import ParameterGrid
+
+    iteration_options = sorted(param_grid["num_iterations"])
+    candidates = list(ParameterGrid({k: v for k, v in param_grid.items() if k != "num_iterations"}))
+    nrungs = int(np.floor(np.log(len(candidates)) / np.log(eta))) + 1
+
+    # LightGBM datasets are built once per fold and data fraction and shared by every candidate
+    datasets = {}
+
+    def fold_data(ifold, fraction):
+        if (ifold, fraction) not in datasets:
+            train_index, test_index = folds[ifold]
+            train_index = train_index[len(train_index) - max(1, int(round(fraction * len(train_index)))):]
+            datasets[(ifold, fraction)] = (lgb.Dataset(X[train_index], y[train_index], free_raw_data=False),
+                                           X[test_index], y[test_index])
+        return datasets[(ifold, fraction)]
+
+    for rung in range(nrungs):
+        scale = float(eta)**(nrungs - 1 - rung)
+        num_rounds = max(1, int(round(iteration_options[-1] / scale)))
+        fraction = max(min_data_fraction, 1.0 / scale)
+        last_rung = rung == nrungs - 1
+        scored = []
+        for candidate in candidates:
+            params = dict(candidate, num_iterations=num_rounds, n_jobs=-1, verbose=-1)
+            scores = np.zeros((len(folds), len(iteration_options)))
+            for ifold in range(len(folds)):
+                dataset, X_test, y_test = fold_data(ifold, fraction)
+                booster = lgb.train(params, dataset)
+                for ioption, num_iterations in enumerate(iteration_options if last_rung else [num_rounds]):
+                    y_pred = booster.predict(X_test, num_iteration=num_iterations)
+                    scores[ifold, ioption] = roc_auc_score(y_test, y_pred, max_fpr=max_fpr)
+            mean_scores = scores.mean(axis=0)
+            best_option = int(np.argmax(mean_scores)) if last_rung else 0
+            scored.append((mean_scores[best_option], candidate, iteration_options[best_option]))
+            print(f"rung {rung} rounds={num_rounds} fraction={fraction:.3f} score={mean_scores[best_option]:.5f} "
+                  f"{candidate}")
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        candidates = [candidate for _, candidate, _ in scored[:max(1, len(scored) // eta)]]
+
+    best_score, best_candidate, best_num_iterations = scored[0]
+    print(f"best score={best_score:.5f}")
+    return dict(best_candidate, num_iterations=best_num_iterations)
+
+
+def optimize_model(data_dir, search="grid"):
     """
+    Run a grid search to find the best LightGBM parameters. With search="halving" the same grid, folds and objective
+    are explored with successive_halving_search instead of training every combination to completion. Both rank the
+    candidates by the partial AUC at an FPR of 5e-3 of their predicted probabilities.
+    """
+    import lightgbm as lgb
+    from sklearn.model_selection import GridSearchCV
+    from sklearn.model_selection import TimeSeriesSplit
+    from sklearn.metrics import roc_auc_score
+
     # Read data
     X_train, y_train = read_vectorized_features(data_dir, subset="train")
 
-    # Filter unlabeled data
-    train_rows = (y_train != -1)
+    # Filter unlabeled data. The search needs the matrix in memory, which is fine for the seven Adobe features.
+    train_rows = feature_store.labeled_rows(y_train)
 
     # read training dataset
-    X_train = X_train[train_rows]
-    y_train = y_train[train_rows]
+    X_train = feature_store.read_rows(X_train, rows=train_rows)
+    y_train = np.asarray(y_train[train_rows])
 
     # score by roc auc
     # we're interested in low FPR rates, so we'll consider only the AUC for FPRs in [0,5e-3]
-    score = make_scorer(roc_auc_score, max_fpr=5e-3)
+    # of the predicted probabilities, as successive_halving_search does, rather than of hard labels
+    def score(estimator, X, y):
+        return roc_auc_score(y, estimator.predict_proba(X)[:, 1], max_fpr=5e-3)
 
     # define search grid
     param_grid = {
@@ -822,17 +1940,25 @@ def optimize_model(data_dir):
     # so this works for progrssive time series splitting
     progressive_cv = TimeSeriesSplit(n_splits=3).split(X_train)
 
-    grid = GridSearchCV(estimator=model, cv=progressive_cv, param_grid=param_grid, scoring=score, n_jobs=1, verbose=3)
-    grid.fit(X_train, y_train)
+    if search == "halving":
+        best_params = successive_halving_search(X_train, y_train, param_grid, list(progressive_cv), max_fpr=5e-3)
+    else:
+        grid = GridSearchCV(estimator=model, cv=progressive_cv, param_grid=param_grid, scoring=score, n_jobs=1,
+                            verbose=3)
+        grid.fit(X_train, y_train)
+        best_params = grid.best_params_
 
-    print(grid.best_params_)
-    json.dump(grid.best_params_, open("adobe_best_params.json", "w"))
+    print(best_params)
+    json.dump(best_params, open("adobe_best_params.json", "w"))
 
 
-def train_model(data_dir):
+def train_model(data_dir, compact=False, params=None):
     """
-    Train the LightGBM model from the EMBER dataset from the vectorized features
+    Train the LightGBM model from the EMBER dataset from the vectorized features. With compact=True the features are
+    read from the store written by compact_vectorized_features. params override the defaults below.
     """
+    import lightgbm as lgb
+
     params = {
         'boosting_type': 'gbdt',
         'objective': 'binary',
@@ -841,16 +1967,20 @@ def train_model(data_dir):
         'num_leaves': 2048,
         'feature_fraction': 0.5,
         'bagging_fraction': 0.5,
+        **(params or {})
     }
 
     # Read data
-    X_train, y_train = read_vectorized_features(data_dir, "train")
+    if compact:
+        X_train, y_train = feature_store.read_compact_features(data_dir, "adobe", "train")
+    else:
+        X_train, y_train = read_vectorized_features(data_dir, "train")
 
     # Filter unlabeled data
-    train_rows = (y_train != -1)
+    train_rows = feature_store.labeled_rows(y_train)
 
-    # Train
-    lgbm_dataset = lgb.Dataset(X_train[train_rows], y_train[train_rows])
+    # Train, streaming the labeled rows into LightGBM instead of copying them
+    lgbm_dataset = feature_store.streamed_dataset(X_train, y_train, train_rows, params=params)
     lgbm_model = lgb.train(params, lgbm_dataset)
     lgbm_model.save_model(os.path.join(data_dir, "adobe_model_optimized.txt"))
 
@@ -861,30 +1991,81 @@ def find_badly_classified_families(data_dir):
     """
     Find classes that are classified poorly by the benchmark model
     """
+    import ember
+    import batch_predict
 
-    emberdf = ember.read_metadata(data_dir)
-    X_train, y_train, X_test, y_test = ember.read_vectorized_features(data_dir)
-    lgbm_model = lgb.Booster(model_file=os.path.join(data_dir, "ember_model_2018.txt"))
-    y_test_pred = lgbm_model.predict(X_test)
-    y_train_pred = lgbm_model.predict(X_train)
-    emberdf["y_pred_ember"] = np.hstack((y_train_pred, y_test_pred))
+    # Only the avclass column of the metadata and the test set predictions are needed
+    metadata = metadata_store.read_metadata_store(data_dir)
+    X_test, y_test = ember.read_vectorized_features(data_dir, "test")
+    y_test_pred = batch_predict.predict_to_memmap(os.path.join(data_dir, "ember_model_2018.txt"), X_test,
+                                                  os.path.join(data_dir, "y_test_pred_ember_model_2018.dat"))
 
     nclasses = 1000
-    detection_rates = []
-    avclass_counts = emberdf[emberdf.subset == "train"].avclass.value_counts()
-    for i, family in enumerate(avclass_counts.index[:nclasses]):
-        familydf = emberdf[(emberdf.subset == "test") & (emberdf.avclass == family)]
-        detection_rates.append((familydf.y_pred_ember > 0.8336).sum() / len(familydf))
-
-    famdf = pd.DataFrame({"avclass": avclass_counts.index[:nclasses], "detection_rates": detection_rates})
-    badly_classified_families = list(famdf[famdf.detection_rates < 0.96498].avclass)
+    avclass = metadata.index("avclass")
+    families = np.asarray(avclass.dictionary, dtype=object)
+    train_counts = avclass.counts(metadata.subset_slice("train"))
+    if "" in avclass.codes:
+        train_counts[avclass.codes[""]] = 0
+    top_families = np.argsort(-train_counts, kind="stable")[:min(nclasses, np.count_nonzero(train_counts))]
+
+    badly_classified_families = []
+    for family in families[top_families]:
+        test_rows = metadata_store.restrict(avclass.rows(family), metadata.subset_slice("test"), relative=True)
+        if len(test_rows) and (y_test_pred[test_rows] > 0.8336).sum() / len(test_rows) < 0.96498:
+            badly_classified_families.append(family)
     open(data_dir + "/badly_classified_families.txt", "w").write("\n".join(badly_classified_families))
 
 
-def train_weighted_model(data_dir):
+def explain_badly_classified_families(data_dir, families=None, chunk_rows=1 << 12, processes=1, top_features=20):
     """
-    Train the LightGBM model from the EMBER dataset from the vectorized features
+    Compute the per-feature contributions of the benchmark model for the test samples of the families written by
+    find_badly_classified_families (or the given families), in chunks into data_dir/contrib_badly_classified.dat, and
+    aggregate them per family. The mean absolute contribution of every feature for every family is saved to
+    family_contributions.npz and the top_features of each family are listed in family_contributions.tsv. Returns the
+    families and the (nfamilies, num_feature + 1) mean absolute contributions, whose last column is the expected value.
     """
+    import ember
+    import batch_predict
+
+    if families is None:
+        families = open(os.path.join(data_dir, "badly_classified_families.txt")).read().split("\n")
+    families = [family for family in families if family]
+    metadata = metadata_store.read_metadata_store(data_dir)
+    avclass = metadata.index("avclass")
+    X_test, _ = ember.read_vectorized_features(data_dir, "test")
+
+    # Rows are grouped by family so that each family is a contiguous segment of the contribution memmap
+    family_rows = [
+        metadata_store.restrict(avclass.rows(family), metadata.subset_slice("test"), relative=True)
+        for family in families
+    ]
+    offsets = np.cumsum([0] + [len(rows) for rows in family_rows])
+    rows = np.concatenate(family_rows) if family_rows else np.empty(0, dtype=np.int64)
+    contributions = batch_predict.predict_to_memmap(os.path.join(data_dir, "ember_model_2018.txt"), X_test,
+                                                    os.path.join(data_dir, "contrib_badly_classified.dat"),
+                                                    chunk_rows=chunk_rows, processes=processes, rows=rows,
+                                                    contrib=True)
+    mean_abs = batch_predict.segment_means(contributions, offsets, absolute=True)
+
+    np.savez(os.path.join(data_dir, "family_contributions.npz"), families=np.array(families), offsets=offsets,
+             rows=rows, mean_abs=mean_abs)
+    with open(os.path.join(data_dir, "family_contributions.tsv"), "w") as f:
+        f.write("family\tsamples\trank\tfeature\tmean_abs_contribution\n")
+        for family, nrows, family_mean_abs in zip(families, np.diff(offsets), mean_abs):
+            for rank, feature in enumerate(np.argsort(-family_mean_abs[:-1], kind="stable")[:top_features]):
+                f.write(f"{family}\t{nrows}\t{rank + 1}\t{feature}\t{family_mean_abs[feature]:.6g}\n")
+    return families, mean_abs
+
+
+def train_weighted_model(data_dir, compact=False, params=None):
+    """
+    Train the LightGBM model from the EMBER dataset from the vectorized features. With compact=True the features are
+    read from the bin codes written by compact_vectorized_features(data_dir, "ember"). params override
+    the defaults below.
+    """
+    import ember
+    import lightgbm as lgb
+
     params = {
         "boosting": "gbdt",
         "objective": "binary",
@@ -893,30 +2074,413 @@ def train_weighted_model(data_dir):
         "num_leaves": 2048,
         "max_depth": 15,
         "min_data_in_leaf": 50,
-        "feature_fraction": 0.5
+        "feature_fraction": 0.5,
+        **(params or {})
     }
 
     # Read data
     badly_classified_families = open(data_dir + "/badly_classified_families.txt").read().strip().split("\n")
-    emberdf = ember.read_metadata(data_dir)
-    X_train, y_train = ember.read_vectorized_features(data_dir, "train")
-    w_train = np.array(emberdf[emberdf.subset == "train"].avclass.isin(badly_classified_families)) + 1
+    metadata = metadata_store.read_metadata_store(data_dir)
+    if compact:
+        X_train, y_train = feature_store.read_compact_features(data_dir, "ember", "train")
+    else:
+        X_train, y_train = ember.read_vectorized_features(data_dir, "train")
+    family_rows = metadata.index("avclass").rows_any(badly_classified_families)
+    w_train = np.ones(len(y_train), dtype=np.float32)
+    w_train[metadata_store.restrict(family_rows, metadata.subset_slice("train"), relative=True)] = 2
 
     # Filter unlabeled data
-    train_rows = (y_train != -1)
+    train_rows = feature_store.labeled_rows(y_train)
 
-    # Train
-    lgbm_dataset = lgb.Dataset(X_train[train_rows], y_train[train_rows], weight=w_train[train_rows])
+    # Train, streaming the labeled rows into LightGBM instead of copying them
+    lgbm_dataset = feature_store.streamed_dataset(X_train, y_train, train_rows, weight=w_train, params=params)
     lgbm_model = lgb.train(params, lgbm_dataset)
     lgbm_model.save_model(os.path.join(data_dir, "ember_model_2018_weighted.txt"))
 
     return lgbm_model
 
 
+def evaluate_weighted_model(data_dir, fpr_target=1e-2):
+    """
+    Compare the weighted model with the benchmark model on the test set and write data_dir/weighted_model_comparison.tsv
+    """
+    import ember
+    import model_comparison
+
+    X_test, y_test = ember.read_vectorized_features(data_dir, "test")
+    models = [os.path.join(data_dir, "ember_model_2018.txt"), os.path.join(data_dir, "ember_model_2018_weighted.txt")]
+    summary = model_comparison.compare_models(X_test, y_test, models, fpr_target=fpr_target)
+    model_comparison.write_comparison_table(summary, os.path.join(data_dir, "weighted_model_comparison.tsv"))
+    return summary
+
+
+def create_metadata_indexes(data_dir, names=("avclass", )):
+    """
+    Rewrite the metadata store of data_dir from its metadata.csv and build the inverted indexes of the columns names,
+    so that the pipeline stages after it only read the store
+    """
+    metadata = metadata_store.create_metadata_store(data_dir)
+    for name in names:
+        metadata.index(name)
+    return metadata
+
+
+def improvement_pipeline(data_dir, adobe_params=None, weighted_params=None, fpr_target=1e-2):
+    """
+    The improvement workflow as a pipeline.Pipeline: vectorize the raw features, build the metadata store, train the
+    Adobe model, find the families the benchmark model misses, train the weighted EMBER model on them and compare it
+    with the benchmark. The Adobe model training and the family search only share the vectorized features and run side
+    by side.
+    """
+    import csv
+    import pipeline
+
+    def path(name):
+        return os.path.join(data_dir, name)
+
+    def raw_feature_path(name):
+        try:
+            return raw_feature_io.find_raw_feature_path(path(name))
+        except Exception:
+            return path(name)
+
+    raw_features = [raw_feature_path(f"train_features_{i}.jsonl") for i in range(6)]
+    raw_features.append(raw_feature_path("test_features.jsonl"))
+    adobe_train = [path("X_train_adobe.dat"), path("y_train_adobe.dat")]
+    adobe_test = [path("X_test_adobe.dat"), path("y_test_adobe.dat")]
+    ember_train = [path("X_train.dat"), path("y_train.dat")]
+    ember_test = [path("X_test.dat"), path("y_test.dat")]
+    benchmark = path("ember_model_2018.txt")
+    families = path("badly_classified_families.txt")
+    weighted = path("ember_model_2018_weighted.txt")
+
+    # The metadata store has one file per metadata.csv column, plus the avclass index the later stages look up
+    metadata_columns = []
+    if os.path.exists(path("metadata.csv")):
+        with open(path("metadata.csv"), newline="") as f:
+            metadata_columns = [name for name in next(csv.reader(f), []) if name]
+    metadata = [os.path.join(path("metadata"), name) for name in ["meta.json", "avclass.index.offsets.npy",
+                                                                  "avclass.index.rows.dat"]]
+    metadata += [os.path.join(path("metadata"), f"{name}.dat") for name in metadata_columns]
+    y_test_pred = path("y_test_pred_ember_model_2018.dat")
+
+    # Raw feature indexes are not declared: raw_feature_io checks them against their raw file itself and keeps them
+    # next to it, in its cache directory or only in memory, wherever it can
+    stages = [
+        pipeline.Stage("vectorize", create_vectorized_features, raw_features,
+                       adobe_train + adobe_test + ember_train + ember_test, args=(data_dir, ("adobe", "ember")),
+                       code=[create_vectorized_features, vectorize_subset, vectorize_lines, raw_feature_values,
+                             AdobeFeatureSet, EmberFeatureSet]),
+        pipeline.Stage("metadata", create_metadata_indexes, [path("metadata.csv")], metadata, args=(data_dir, ),
+                       params={"names": ["avclass"]}),
+        pipeline.Stage("train_adobe", train_model, adobe_train,
+                       [path("adobe_model_optimized.txt"), path("y_train_adobe.dat.labeled.npy")], args=(data_dir, ),
+                       params={"params": adobe_params}),
+        pipeline.Stage("find_families", find_badly_classified_families,
+                       ember_test + [benchmark, path("metadata.csv")] + metadata,
+                       [families, y_test_pred, y_test_pred + ".done", y_test_pred + ".json"], args=(data_dir, )),
+        pipeline.Stage("train_weighted", train_weighted_model,
+                       ember_train + [path("metadata.csv"), families] + metadata,
+                       [weighted, path("y_train.dat.labeled.npy")], args=(data_dir, ),
+                       params={"params": weighted_params}),
+        pipeline.Stage("evaluate", evaluate_weighted_model, ember_test + [benchmark, weighted],
+                       [path("weighted_model_comparison.tsv")], args=(data_dir, ), params={"fpr_target": fpr_target}),
+    ]
+    return pipeline.Pipeline(stages, path("pipeline_state"))
+
+
+def run_improvement_pipeline(data_dir, targets=None, force=(), processes=2, **kwargs):
+    """
+    Run the stages of improvement_pipeline that are not up to date, two at a time by default, and return their names
+    """
+    return improvement_pipeline(data_dir, **kwargs).run(targets, force, processes)
+
+
+def read_feature_set(data_dir, feature_set="adobe", subset="train", compact=False):
+    """
+    Read the vectorized features of one subset of a feature set ("adobe" or "ember"), from the compact store if
+    compact=True
+    """
+    if compact:
+        return feature_store.read_compact_features(data_dir, feature_set, subset)
+    if feature_set == "adobe":
+        return read_vectorized_features(data_dir, subset)
+    import ember
+    return ember.read_vectorized_features(data_dir, subset)
+
+
+def compact_vectorized_features(data_dir, feature_set="adobe", max_bin=255):
+    """
+    Convert the float32 vectorized features of a feature set ("adobe" or "ember") to the compact store. The Adobe
+    features are integers and are stored losslessly in a feature_store.CompactMatrix. The EMBER features are stored as
+    LightGBM aligned bin codes in a feature_store.BinnedMatrix. Labels are stored as int8 for both.
+    """
+    train_bins = None
+    for subset in ["train", "test"]:
+        X, y = read_feature_set(data_dir, feature_set, subset)
+        X_path, y_path = feature_store.compact_paths(data_dir, feature_set, subset)
+        if feature_set == "adobe":
+            matrix = feature_store.CompactMatrix.write(X_path, X)
+        else:
+            matrix = feature_store.BinnedMatrix.write(X_path, X, max_bin=max_bin, bins_from=train_bins)
+            if train_bins is None:
+                train_bins = matrix
+        feature_store.write_labels(y_path, y)
+
+        before = X.nbytes + y.nbytes
+        after = matrix.nbytes + len(y)
+        print(f"{feature_set} {subset}: {before} bytes -> {after} bytes ({after / before:.1%})")
+
+
+def partitioned_path(data_dir, feature_set="adobe", compact=False):
+    return os.path.join(data_dir, f"X_{feature_set}{'_compact' if compact else ''}_by_month")
+
+
+def partition_sources(data_dir, feature_set="adobe", compact=False):
+    """
+    Return the path, size and mtime of every file a partitioned store is built from: the features and labels of both
+    subsets and the metadata store's "appeared" column
+    """
+    import batch_predict
+
+    parts = [read_feature_set(data_dir, feature_set, subset, compact) for subset in ["train", "test"]]
+    appeared = metadata_store.read_metadata_store(data_dir).codes("appeared")
+    signatures = [batch_predict.input_signature(array) for part in parts for array in part]
+    return signatures + [batch_predict.input_signature(appeared)]
+
+
+def partition_vectorized_features(data_dir, feature_set="adobe", compact=False):
+    """
+    Write the train and test rows of a feature set ("adobe" or "ember") partitioned by "appeared" month, using the
+    metadata store's month index, as a feature_store.PartitionedMatrix. With compact=True the rows are read from the
+    compact store, which for EMBER means its bin values, and written to a separate store. The partitions are float32
+    either way. Rerun it whenever the features or the metadata store change.
+    """
+    metadata = metadata_store.read_metadata_store(data_dir)
+    index = metadata.index("appeared")
+    parts = [read_feature_set(data_dir, feature_set, subset, compact) for subset in ["train", "test"]]
+    if sum(len(y) for _, y in parts) != len(metadata):
+        raise Exception(f"The {feature_set} features and the metadata store of {data_dir} have different row counts")
+    partitions = [(month, index.rows(month)) for month in index.dictionary]
+    return feature_store.PartitionedMatrix.write(partitioned_path(data_dir, feature_set, compact), parts, partitions,
+                                                 sources=partition_sources(data_dir, feature_set, compact))
+
+
+def partitions_current(data_dir, feature_set="adobe", compact=False):
+    """
+    Return whether the store written by partition_vectorized_features exists and its source matrices and months are
+    unchanged since. Stores written before sources were recorded count as stale.
+    """
+    path = partitioned_path(data_dir, feature_set, compact) + ".json"
+    if not os.path.exists(path):
+        return False
+    return json.load(open(path)).get("sources") == partition_sources(data_dir, feature_set, compact)
+
+
+def read_partitioned_features(data_dir, feature_set="adobe", first_month=None, last_month=None, compact=False):
+    """
+    Return zero-copy (X, y) views of the rows that appeared from first_month to last_month, in month order, from the
+    store written by partition_vectorized_features. Raises if the features were rewritten after it was partitioned.
+    """
+    path = partitioned_path(data_dir, feature_set, compact)
+    if not partitions_current(data_dir, feature_set, compact):
+        raise Exception(f"{path} is missing or older than its source features; rerun partition_vectorized_features")
+    return feature_store.PartitionedMatrix(path).between(first_month, last_month)
+
+
+def read_month_features(data_dir, first_month, last_month, feature_set="adobe", compact=False):
+    """
+    Read into memory the labeled rows of both subsets that appeared from first_month to last_month. If the features
+    were partitioned by month with partition_vectorized_features only those months are read. Partitions older than the
+    features or the metadata store raise rather than being rebuilt behind the caller's back.
+    """
+    if os.path.exists(partitioned_path(data_dir, feature_set, compact) + ".json"):
+        X, y = read_partitioned_features(data_dir, feature_set, first_month, last_month, compact)
+        labeled = np.flatnonzero(np.asarray(y) != -1)
+        return np.asarray(X[labeled]), np.asarray(y[labeled])
+
+    metadata = metadata_store.read_metadata_store(data_dir)
+    month_rows = metadata.rows_between("appeared", first_month, last_month)
+    X_parts, y_parts = [], []
+    for subset in ["train", "test"]:
+        rows = metadata_store.restrict(month_rows, metadata.subset_slice(subset), relative=True)
+        X, y = read_feature_set(data_dir, feature_set, subset, compact)
+        y_rows = np.asarray(y[rows], dtype=np.float32)
+        rows = rows[y_rows != -1]
+        X_parts.append(feature_store.read_rows(X, rows=rows))
+        y_parts.append(y_rows[y_rows != -1])
+    return np.concatenate(X_parts), np.concatenate(y_parts)
+
+
+incremental_models = {"adobe": "adobe_model_optimized.txt", "ember": "ember_model_2018_weighted.txt"}
+
+
+def continue_training(data_dir, first_month, last_month, holdout_month, feature_set="adobe", num_rounds=100,
+                      compact=False, init_model=None, model_path=None):
+    """
+    Add num_rounds trees to an existing model instead of retraining from scratch. The new trees are trained only on
+    the rows that appeared from first_month to last_month and every round is evaluated on the rows of holdout_month.
+    The model is saved next to its parent with the last month as a suffix, together with a <model>.lineage.json that
+    records the parent, the data and the holdout AUC per round.
+    """
+    import hashlib
+    import datetime
+    import lightgbm as lgb
+    from sklearn.metrics import roc_auc_score
+
+    if init_model is None:
+        init_model = os.path.join(data_dir, incremental_models[feature_set])
+    if model_path is None:
+        root, ext = os.path.splitext(init_model)
+        model_path = f"{root}_{last_month}{ext or '.txt'}"
+    init_booster = lgb.Booster(model_file=init_model)
+    params = dict(init_booster.params, num_iterations=num_rounds, metric="auc")
+    if compact and feature_set == "ember":
+        # Bin the decoded rows with the bounds they were encoded with, as feature_store.streamed_dataset does
+        params.update(read_feature_set(data_dir, "ember", "train", compact)[0].dataset_params)
+
+    X_train, y_train = read_month_features(data_dir, first_month, last_month, feature_set, compact)
+    X_holdout, y_holdout = read_month_features(data_dir, holdout_month, holdout_month, feature_set, compact)
+    if len(y_train) == 0 or len(y_holdout) == 0:
+        raise Exception(f"No labeled rows for months {first_month} to {last_month} or holdout month {holdout_month}")
+
+    # The init scores of both datasets come from the parent model, so the holdout AUC is that of the combined model
+    lgbm_dataset = lgb.Dataset(X_train, y_train, free_raw_data=False)
+    lgbm_holdout = lgb.Dataset(X_holdout, y_holdout, reference=lgbm_dataset, free_raw_data=False)
+    holdout_auc = {}
+    lgbm_model = lgb.train(params, lgbm_dataset, init_model=init_booster, valid_sets=[lgbm_holdout],
+                           valid_names=["holdout"], callbacks=[lgb.record_evaluation(holdout_auc)])
+    lgbm_model.save_model(model_path)
+
+    parent_lineage = init_model + ".lineage.json"
+    lineage = {
+        "model": os.path.basename(model_path),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "parent": os.path.basename(init_model),
+        "parent_sha256": hashlib.sha256(open(init_model, "rb").read()).hexdigest(),
+        "parent_iterations": init_booster.current_iteration(),
+        "parent_lineage": json.load(open(parent_lineage)) if os.path.exists(parent_lineage) else None,
+        "added_iterations": lgbm_model.current_iteration() - init_booster.current_iteration(),
+        "feature_set": feature_set,
+        "train_months": [first_month, last_month],
+        "train_rows": len(y_train),
+        "holdout_month": holdout_month,
+        "holdout_rows": len(y_holdout),
+        "holdout_auc_parent": roc_auc_score(y_holdout, init_booster.predict(X_holdout)),
+        "holdout_auc": holdout_auc["holdout"]["auc"],
+        "params": {k: params[k] for k in ["num_iterations", "learning_rate", "num_leaves", "feature_fraction"]},
+    }
+    json.dump(lineage, open(model_path + ".lineage.json", "w"), indent=1)
+    print(f"Holdout AUC {lineage['holdout_auc_parent']:.6f} -> {lineage['holdout_auc'][-1]:.6f}")
+
+    return lgbm_model
+
+
+distillation_configs = [
+    {"num_iterations": 50, "num_leaves": 32},
+    {"num_iterations": 100, "num_leaves": 64},
+    {"num_iterations": 200, "num_leaves": 128},
+    {"num_iterations": 400, "num_leaves": 256},
+]
+
+
+def distill_model(teacher_file, X_train, X_test, y_test, out_prefix, configs=None, max_features=None,
+                  latency_budget=None, max_fpr=5e-3, params=None):
+    """
+    Fit small boosters to the soft labels teacher_file gives every row of X_train, labeled or not, with a cross
+    entropy objective, one per entry of configs (distillation_configs by default). With max_features only the teacher's
+    top features by gain may be split on; the students still take the full feature vector, so they load and score
+    anywhere the teacher does. Each student is saved as <out_prefix>_<trees>x<leaves>[_f<features>].txt.
+
+    The teacher and every student are scored on the labeled rows of X_test: partial AUC at max_fpr, mean absolute
+    difference from the teacher, and single-row and batch prediction latency, written to <out_prefix>.tsv. With
+    latency_budget (seconds per single-row prediction) the student with the best partial AUC within the budget is
+    copied to <out_prefix>.txt. Returns the table as a list of dictionaries.
+    """
+    import shutil
+    import lightgbm as lgb
+    import batch_predict
+    import model_registry
+    import model_comparison
+    from sklearn.metrics import roc_auc_score
+
+    teacher = model_registry.load_booster(teacher_file)
+    soft_labels = batch_predict.predict_to_memmap(teacher_file, X_train, out_prefix + "_soft_labels.dat")
+    feature_penalty = None
+    if max_features is not None:
+        keep = np.argsort(-teacher.feature_importance("gain"), kind="stable")[:max_features]
+        feature_penalty = np.zeros(teacher.num_feature())
+        feature_penalty[keep] = 1
+    # Every student trains on the same dataset, binned once with the shared parameters
+    params = {"objective": "cross_entropy", "learning_rate": 0.1, "min_data_in_leaf": 50, "verbose": -1,
+              **(params or {})}
+    dataset = feature_store.streamed_dataset(X_train, soft_labels, rows=np.arange(len(soft_labels)), params=params)
+
+    model_files = [teacher_file]
+    for config in configs or distillation_configs:
+        student_params = {**params, **config}
+        if feature_penalty is not None:
+            student_params["feature_penalty"] = feature_penalty.tolist()
+        student = lgb.train(student_params, dataset)
+        suffix = f"_f{max_features}" if max_features is not None else ""
+        model_file = f"{out_prefix}_{student.num_trees()}x{config['num_leaves']}{suffix}.txt"
+        student.save_model(model_file)
+        model_files.append(model_file)
+
+    test_rows = feature_store.labeled_rows(y_test)
+    y = np.asarray(y_test[test_rows])
+    teacher_pred = None
+    table = []
+    for model_file in model_files:
+        model = model_registry.load_booster(model_file)
+        y_pred = batch_predict.predict_to_memmap(model_file, X_test, os.path.splitext(model_file)[0] + "_test_pred.dat")
+        y_pred = np.asarray(y_pred[test_rows], dtype=np.float64)
+        teacher_pred = y_pred if teacher_pred is None else teacher_pred
+        single_row, batch = model_comparison.prediction_latency(model, X_test)
+        table.append({
+            "model": os.path.basename(model_file),
+            "trees": model.num_trees(),
+            "features": int(np.count_nonzero(model.feature_importance("split"))),
+            "partial_auc": roc_auc_score(y, y_pred, max_fpr=max_fpr),
+            "mean_abs_diff": float(np.abs(y_pred - teacher_pred).mean()),
+            "single_row_us": single_row * 1e6,
+            "batch_us": batch * 1e6,
+            "bytes": os.path.getsize(model_file)
+        })
+
+    with open(out_prefix + ".tsv", "w") as f:
+        f.write("\t".join(table[0]) + "\n")
+        for row in table:
+            f.write("\t".join(f"{value:.6g}" if isinstance(value, float) else str(value) for value in row.values()))
+            f.write("\n")
+    if latency_budget is not None:
+        within = [(row, model_file) for row, model_file in zip(table[1:], model_files[1:])
+                  if row["single_row_us"] <= latency_budget * 1e6]
+        if not within:
+            raise Exception(f"No distilled model predicts a single row within {latency_budget} seconds")
+        row, model_file = max(within, key=lambda candidate: candidate[0]["partial_auc"])
+        shutil.copyfile(model_file, out_prefix + ".txt")
+        print(f"{row['model']}: partial AUC {row['partial_auc']:.6f} at {row['single_row_us']:.1f} us per sample")
+    return table
+
+
+def distill_ember_model(data_dir, teacher="ember_model_2018.txt", compact=False, **kwargs):
+    """
+    Distill an EMBER model of data_dir (the benchmark or ember_model_2018_weighted.txt) on the vectorized train set
+    and evaluate the students on the test set with distill_model. Outputs are named <teacher>_distilled*.
+    """
+    X_train, _ = read_feature_set(data_dir, "ember", "train", compact)
+    X_test, y_test = read_feature_set(data_dir, "ember", "test", compact)
+    out_prefix = os.path.join(data_dir, os.path.splitext(teacher)[0] + "_distilled")
+    return distill_model(os.path.join(data_dir, teacher), X_train, X_test, y_test, out_prefix, **kwargs)
+
+
 def train_multiple(data_dir):
     """
     Train a bunch of models to explore how different they are
     """
+    import ember
+
     params = {
         "boosting": "gbdt",
         "objective": "binary",
@@ -933,19 +2497,28 @@ def train_multiple(data_dir):
         lgbm_model.save_model(os.path.join(data_dir, f"ember_model_2018_random{i}.txt"))
 
 
-def find_disagreements(data_dir, samples_dir):
+def find_disagreements(data_dir, samples_dir, pack_path=None):
     """
     A bunch of samples will have different Adobe features from EMBER than from the original implementation. This is
     due to pefile and lief parsing sections in differnet orders. Sometimes, the Virtual Size of the second section
     will differ because pefile and lief disagree about which is the second section.
+
+    With pack_path the sample headers are read from that HeaderPack (see pack_sample_headers) instead of opening every
+    sample file; samples missing from the pack fall back to samples_dir.
     """
-    for jsonl_file in glob.glob(f"{data_dir}/*jsonl"):
-        for line in open(jsonl_file):
+    pack = header_pack.HeaderPack(pack_path) if pack_path is not None else None
+    for jsonl_file in sorted(glob.glob(f"{data_dir}/*jsonl*")):
+        if not raw_feature_io.is_raw_feature_path(jsonl_file):
+            continue
+        for line in raw_feature_io.raw_feature_iterator([jsonl_file]):
             raw_feature_dict = json.loads(line)
             sha256 = raw_feature_dict["sha256"]
-            path = f"{samples_dir}/{sha256[0]}/{sha256[1]}/{sha256[2]}/{sha256}"
+            header = pack.get(sha256) if pack is not None else None
             eval_rf = AdobeEval(raw_features=raw_feature_dict)
-            eval_p = AdobeEval(path=path)
+            if header is not None:
+                eval_p = AdobeEval(data=header)
+            else:
+                eval_p = AdobeEval(path=sample_path(samples_dir, sha256))
             if eval_rf.init_success and eval_p.init_success and eval_p != eval_rf:
                 print(sha256)
                 for f in AdobeEval.ordered_features:
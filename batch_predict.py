@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# Out-of-core batch prediction. The rows of a memmapped or compact feature matrix are scored in fixed size chunks and
+# written straight into a preallocated memmap, so peak memory is one chunk per worker plus the model, whatever the
+# number of rows. A bitmap of finished chunks next to the output makes an interrupted run resumable.
+import os
+import json
+import mmap
+import hashlib
+import multiprocessing
+import numpy as np
+import feature_store
+import model_registry
+
+# Set in the parent before the workers are forked, so that the feature matrix and the loaded model are shared rather
+# than pickled or loaded again by every worker
+_job = {}
+
+
+def load_predictor(model_file, engine="lightgbm"):
+    """
+    Load a model for prediction from model_registry: a lightgbm.Booster, or the compiled model with engine="compiled"
+    """
+    if engine == "compiled":
+        return model_registry.load_model(model_file)
+    return model_registry.load_booster(model_file)
+
+
+def file_mapping(X):
+    """
+    Return the mmap.mmap behind a memmap or a view of one, following the public base chain, or None
+    """
+    base = X
+    while isinstance(base, np.ndarray):
+        base = base.base
+    return base if isinstance(base, mmap.mmap) else None
+
+
+def read_chunk(X, start, stop):
+    """
+    Read rows start to stop of X. Rows of a memmapped matrix are read from its file with a plain read and then, where
+    the platform supports posix_fadvise, dropped from the page cache, so that neither the process nor the page cache
+    keeps the rows already scored. Other matrices go through feature_store.read_rows.
+    """
+    mapping = file_mapping(X) if isinstance(X, np.memmap) else None
+    if mapping is None or X.ndim != 2 or not X.flags.c_contiguous or X.filename is None:
+        return feature_store.read_rows(X, start, stop)
+
+    # X may be a view of a larger memmap: locate it in the file through its address within the mapping
+    mapping_start = X.offset - X.offset % mmap.ALLOCATIONGRANULARITY
+    mapping_address = np.frombuffer(mapping, dtype=np.uint8).ctypes.data
+    row_bytes = X.shape[1] * X.itemsize
+    position = mapping_start + X.ctypes.data - mapping_address + start * row_bytes
+    with open(X.filename, "rb") as f:
+        f.seek(position)
+        rows = np.fromfile(f, dtype=X.dtype, count=(stop - start) * X.shape[1]).reshape(stop - start, X.shape[1])
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), position, (stop - start) * row_bytes, os.POSIX_FADV_DONTNEED)
+    return rows
+
+
+def predict_chunk(ichunk):
+    """
+    Score one chunk of the current job and write it to the output memmap
+    """
+    X, out_path, nrows, chunk_rows = _job["X"], _job["out_path"], _job["nrows"], _job["chunk_rows"]
+    start = ichunk * chunk_rows
+    stop = min(start + chunk_rows, nrows)
+    if _job["rows"] is None:
+        X_chunk = read_chunk(X, start, stop)
+    else:
+        X_chunk = feature_store.read_rows(X, rows=_job["rows"][start:stop])
+    if _job["engine"] == "lightgbm":
+        y_pred = _job["model"].predict(X_chunk, num_threads=_job["num_threads"], pred_contrib=_job["contrib"])
+    else:
+        y_pred = _job["model"].predict(X_chunk)
+    out = np.memmap(out_path, dtype=_job["dtype"], mode="r+", shape=output_shape(nrows, _job["ncols"]))
+    out[start:stop] = y_pred
+    out.flush()
+    return ichunk
+
+
+def input_signature(X):
+    """
+    Return the path, size and mtime of the file behind a memmap (or the metadata file of a compact store reader), so
+    that a rewritten feature matrix is not mistaken for the one an earlier run scored. None for in-memory arrays.
+    """
+    path = getattr(X, "filename", None)
+    if path is None and getattr(X, "path", None) is not None:
+        path = X.path + ".json"
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def output_shape(nrows, ncols):
+    return nrows if ncols is None else (nrows, ncols)
+
+
+def predict_to_memmap(model_file, X, out_path, chunk_rows=1 << 16, processes=1, num_threads=None, engine="lightgbm",
+                      dtype="float32", rows=None, contrib=False):
+    """
+    Write the predictions of model_file for every row of X to a memmap at out_path and return it. X can be a memmap or
+    a compact store reader. The model is loaded once in this process; with processes > 1 the chunks are spread over
+    forked workers that inherit it copy-on-write. num_threads pins the threads each LightGBM worker predicts with. It
+    defaults to every core (0) for a single process and to one thread per worker otherwise (engine="compiled" is
+    single threaded).
+
+    rows selects and orders the rows of X to score. contrib=True writes LightGBM's per-feature contributions instead
+    (pred_contrib), an (nrows, num_feature + 1) output whose last column is the expected value; LightGBM returns them
+    as float64, so chunk_rows should be a few thousand rows for wide feature sets.
+
+    Finished chunks are recorded in <out_path>.done. Rerunning with the same model file, input file, rows and chunk
+    size resumes where an interrupted run stopped; anything else, including any in-memory X, starts over.
+    """
+    if contrib and engine != "lightgbm":
+        raise Exception("Feature contributions are only available with engine=\"lightgbm\"")
+    if num_threads is None:
+        num_threads = 0 if processes == 1 else 1
+    nrows = len(X) if rows is None else len(rows)
+    model = load_predictor(model_file, engine)
+    ncols = model.num_feature() + 1 if contrib else None
+    stat = os.stat(model_file)
+    job = {"model_file": os.path.abspath(model_file), "model_size": stat.st_size, "model_mtime": stat.st_mtime_ns,
+           "input": input_signature(X), "nrows": nrows, "chunk_rows": chunk_rows, "engine": engine, "dtype": dtype,
+           "contrib": contrib, "ncols": ncols}
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+        job["rows_sha256"] = hashlib.sha256(rows.tobytes()).hexdigest()
+    nchunks = (nrows + chunk_rows - 1) // chunk_rows
+    meta_path = out_path + ".json"
+    # An in-memory X has no file signature to tell it from another array of the same length, so it is never resumed
+    resume = (job["input"] is not None and os.path.exists(meta_path) and os.path.exists(out_path) and
+              os.path.exists(out_path + ".done") and json.load(open(meta_path)) == job)
+    if not resume:
+        np.memmap(out_path, dtype=dtype, mode="w+", shape=output_shape(max(nrows, 1), ncols)).flush()
+        np.memmap(out_path + ".done", dtype=np.uint8, mode="w+", shape=max(nchunks, 1)).flush()
+        json.dump(job, open(meta_path, "w"))
+    done = np.memmap(out_path + ".done", dtype=np.uint8, mode="r+", shape=max(nchunks, 1))
+    todo = [ichunk for ichunk in range(nchunks) if not done[ichunk]]
+
+    _job.clear()
+    _job.update(job, X=X, rows=rows, out_path=out_path, num_threads=num_threads, model=model)
+    if processes > 1 and len(todo) > 1:
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            for ichunk in pool.imap_unordered(predict_chunk, todo):
+                done[ichunk] = 1
+                done.flush()
+    else:
+        for ichunk in todo:
+            done[predict_chunk(ichunk)] = 1
+            done.flush()
+    _job.clear()
+
+    return np.memmap(out_path, dtype=dtype, mode="r", shape=output_shape(nrows, ncols))
+
+
+def segment_means(values, offsets, absolute=False, chunk_rows=1 << 14):
+    """
+    Return the (nsegments, ncols) column means of the consecutive row segments [offsets[i], offsets[i + 1]) of a 2-D
+    memmap, such as the contributions of rows grouped by family, reading chunk_rows rows at a time. Means of the
+    absolute values with absolute=True. Empty segments get zeros.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    sums = np.zeros((len(offsets) - 1, values.shape[1]), dtype=np.float64)
+    for start, stop in feature_store.chunk_ranges(int(offsets[-1]) - int(offsets[0]), chunk_rows):
+        start, stop = start + offsets[0], stop + offsets[0]
+        chunk = np.asarray(values[start:stop], dtype=np.float64)
+        if absolute:
+            chunk = np.abs(chunk)
+        # The segments that overlap this chunk, and where each begins within it
+        first = np.searchsorted(offsets, start, side="right") - 1
+        last = np.searchsorted(offsets, stop, side="left")
+        bounds = np.clip(offsets[first:last + 1], start, stop) - start
+        nonempty = bounds[:-1] < bounds[1:]
+        segment_sums = np.add.reduceat(chunk, bounds[:-1][nonempty], axis=0)
+        sums[first:last][nonempty] += segment_sums
+    counts = np.diff(offsets)
+    return sums / np.maximum(counts, 1)[:, None]
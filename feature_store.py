@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+
+# Compact on-disk storage for the vectorized feature matrices written by adobe.create_vectorized_features and
+# ember.create_vectorized_features. Only NumPy is needed to read and write the stores; converting and partitioning a
+# data directory's matrices, which needs the feature readers and the metadata store, lives in adobe.
+import os
+import json
+import numpy as np
+
+
+def narrowest_dtype(minimum, maximum):
+    """
+    Return the smallest integer dtype that can hold every value in [minimum, maximum]
+    """
+    for dtype in [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.uint64, np.int64]:
+        info = np.iinfo(dtype)
+        if info.min <= minimum and maximum <= info.max:
+            return np.dtype(dtype)
+    raise Exception(f"No integer dtype holds [{minimum}, {maximum}]")
+
+
+def chunk_ranges(nrows, chunk_rows):
+    """
+    Yield (start, stop) row ranges covering nrows in chunks of at most chunk_rows
+    """
+    for start in range(0, nrows, chunk_rows):
+        yield start, min(start + chunk_rows, nrows)
+
+
+class CompactMatrix:
+    """
+    A feature matrix of integer valued columns stored losslessly with one memmapped file per column, each narrowed to
+    the smallest integer dtype that holds its values. Rows are returned as float32 so the reader can be used anywhere
+    the original float32 matrix was.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(path + ".json"))
+        self.shape = tuple(self.meta["shape"])
+        self.columns = [
+            np.memmap(f"{path}.{icol}.dat", dtype=dtype, mode="r", shape=self.shape[0])
+            for icol, dtype in enumerate(self.meta["dtypes"])
+        ]
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns)
+
+    def read(self, start=0, stop=None, rows=None):
+        """
+        Return rows [start, stop), or the rows indexed by rows, as a float32 array
+        """
+        index = slice(start, stop) if rows is None else rows
+        return np.column_stack([column[index] for column in self.columns]).astype(np.float32)
+
+    @classmethod
+    def write(cls, path, X, chunk_rows=1 << 20):
+        """
+        Write the integer valued matrix X, such as the memmap from adobe.read_vectorized_features, as a CompactMatrix
+        """
+        nrows, ncols = X.shape
+        minimum = np.zeros(ncols)
+        maximum = np.zeros(ncols)
+        for start, stop in chunk_ranges(nrows, chunk_rows):
+            chunk = np.asarray(X[start:stop])
+            if not np.array_equal(chunk, np.round(chunk)):
+                raise Exception(f"{path}: CompactMatrix only stores integer valued features")
+            minimum = np.minimum(minimum, chunk.min(axis=0))
+            maximum = np.maximum(maximum, chunk.max(axis=0))
+
+        dtypes = [narrowest_dtype(minimum[icol], maximum[icol]) for icol in range(ncols)]
+        columns = [
+            np.memmap(f"{path}.{icol}.dat", dtype=dtype, mode="w+", shape=nrows) for icol, dtype in enumerate(dtypes)
+        ]
+        for start, stop in chunk_ranges(nrows, chunk_rows):
+            chunk = np.asarray(X[start:stop])
+            for icol, column in enumerate(columns):
+                column[start:stop] = chunk[:, icol]
+        for column in columns:
+            column.flush()
+        json.dump({"shape": [nrows, ncols], "dtypes": [dtype.name for dtype in dtypes]}, open(path + ".json", "w"))
+        return cls(path)
+
+
+class BinnedMatrix:
+    """
+    A feature matrix stored as per-column bin codes (uint8 for up to 256 bins, uint16 otherwise) plus a table of one
+    representative float32 value per bin. The bins follow LightGBM's histogram construction: a column with few
+    distinct values gets one bin per value, otherwise the upper bounds are placed at quantiles of a row sample of
+    bin_construct_sample_cnt rows, and LightGBM's own bounds around zero are always added. The encoding is lossy with
+    respect to the original float32 values.
+
+    Left to itself LightGBM would put its thresholds halfway between the decoded values, inside the bins, and a model
+    trained on them would then route raw float32 rows differently from their decoded rows. Training on a BinnedMatrix
+    therefore forces these bounds on LightGBM through dataset_params, so that every threshold is a bin bound and the
+    model scores raw rows exactly as it scores their bin representatives.
+    """
+
+    # LightGBM's kZeroThreshold: it always bounds a bin at -kZeroThreshold and at +kZeroThreshold
+    zero_threshold = np.float32(1e-35)
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(path + ".json"))
+        self.shape = tuple(self.meta["shape"])
+        self.codes = np.memmap(path + ".codes.dat", dtype=self.meta["dtype"], mode="r", shape=self.shape)
+        bins = np.load(path + ".bins.npz")
+        self.upper_bounds = bins["upper_bounds"]
+        self.bin_values = bins["bin_values"]
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def read(self, start=0, stop=None, rows=None):
+        """
+        Return rows [start, stop), or the rows indexed by rows, decoded to float32 bin values
+        """
+        codes = self.codes[start:stop] if rows is None else self.codes[rows]
+        return self.bin_values[np.arange(self.shape[1]), codes]
+
+    @property
+    def dataset_params(self):
+        """
+        The lightgbm.Dataset parameters that make LightGBM bin decoded rows with exactly the bounds of this matrix
+        """
+        forced_path = self.path + ".forcedbins.json"
+        if not os.path.exists(forced_path):
+            raise Exception(f"{self.path} was written without its LightGBM forced bins, rewrite it with "
+                            "adobe.compact_vectorized_features")
+        # LightGBM fails when the forced bounds leave it no bins of its own, even though it finds nothing to split
+        return {"max_bin": 2 * self.meta["max_bin"], "forcedbins_filename": forced_path}
+
+    @classmethod
+    def find_bins(cls, sample, max_bin):
+        """
+        Return the (upper bounds, representative values) of the bins of each column of a row sample. Both are
+        (ncols, max_bin) arrays, padded with +inf and with the value of the last bin respectively.
+
+        LightGBM fills the space between consecutive forced bounds, from one bound up to just below the next, with
+        bounds of its own wherever it finds two distinct values there. Each bin is therefore represented by a value
+        strictly inside it, the midpoint of its bounds, and the first and last bins by the float32 just inside their
+        one finite bound; the bin around zero is represented by 0. Sample values within LightGBM's zero bin are not
+        made bounds, as LightGBM counts them as zeros.
+        """
+        ncols = sample.shape[1]
+        upper_bounds = np.full((ncols, max_bin), np.inf, dtype=np.float32)
+        bin_values = np.zeros((ncols, max_bin), dtype=np.float32)
+        zero_bounds = np.array([-cls.zero_threshold, cls.zero_threshold], dtype=np.float32)
+        # The two zero bounds and the last bin above every bound leave max_bin - 3 bounds for the values
+        nvalues = max_bin - 3
+        for icol in range(ncols):
+            values, counts = np.unique(sample[:, icol], return_counts=True)
+            if len(values) > nvalues:
+                # Place bin ends at quantiles of the sample, merging quantiles that land on the same value
+                targets = np.arange(1, nvalues) * (counts.sum() / nvalues)
+                ends = np.unique(np.searchsorted(np.cumsum(counts), targets))
+                ends = np.append(ends[ends < len(values) - 1], len(values) - 1)
+                values = values[ends]
+            bounds = np.union1d(values[np.abs(values) > cls.zero_threshold], zero_bounds)
+            lower, upper = bounds[:-1], bounds[1:]
+            midpoints = ((lower.astype(np.float64) + upper) / 2).astype(np.float32)
+            # A bin holding a single float32 has no inside, only its upper bound
+            midpoints = np.where(midpoints > lower, midpoints, upper)
+            upper_bounds[icol, :len(bounds)] = bounds
+            bin_values[icol, 0] = np.nextafter(bounds[0], np.float32(-np.inf))
+            bin_values[icol, 1:len(bounds)] = midpoints
+            bin_values[icol, len(bounds):] = np.nextafter(bounds[-1], np.float32(np.inf))
+        return upper_bounds, bin_values
+
+    @classmethod
+    def write(cls, path, X, max_bin=255, bin_construct_sample_cnt=200000, bins_from=None, chunk_rows=1 << 14,
+              seed=0):
+        """
+        Write the float matrix X, such as the memmap from ember.read_vectorized_features, as a BinnedMatrix. Pass the
+        BinnedMatrix of the training set as bins_from when writing the test set so both share the same bins.
+        """
+        nrows, ncols = X.shape
+        if bins_from is not None:
+            upper_bounds, bin_values = bins_from.upper_bounds, bins_from.bin_values
+        else:
+            nsample = min(nrows, bin_construct_sample_cnt)
+            sample_rows = np.sort(np.random.default_rng(seed).choice(nrows, nsample, replace=False))
+            upper_bounds, bin_values = cls.find_bins(np.asarray(X[sample_rows]), max_bin)
+        np.savez(path + ".bins.npz", upper_bounds=upper_bounds, bin_values=bin_values)
+        forced_bins = [{"feature": icol, "bin_upper_bound": [float(bound) for bound in bounds[np.isfinite(bounds)]]}
+                       for icol, bounds in enumerate(upper_bounds)]
+        json.dump(forced_bins, open(path + ".forcedbins.json", "w"))
+
+        dtype = np.dtype(np.uint8) if upper_bounds.shape[1] <= 256 else np.dtype(np.uint16)
+        codes = np.memmap(path + ".codes.dat", dtype=dtype, mode="w+", shape=(nrows, ncols))
+        for start, stop in chunk_ranges(nrows, chunk_rows):
+            chunk = np.asarray(X[start:stop])
+            for icol in range(ncols):
+                codes[start:stop, icol] = np.searchsorted(upper_bounds[icol], chunk[:, icol], side="left")
+        codes.flush()
+        json.dump({"shape": [nrows, ncols], "dtype": dtype.name, "max_bin": int(upper_bounds.shape[1])},
+                  open(path + ".json", "w"))
+        return cls(path)
+
+
+class PartitionedMatrix:
+    """
+    A float32 feature matrix and its labels with the rows grouped into partitions, such as "appeared" months, and
+    stored partition after partition in key order. Every run of consecutive partitions is then one contiguous block of
+    rows, so any key range opens as a zero-copy memmap view without touching the rest of the corpus. source_rows maps
+    each row back to its row in the matrices it was written from (the metadata store order).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(path + ".json"))
+        self.shape = tuple(self.meta["shape"])
+        self.keys = self.meta["keys"]
+        self.offsets = np.array(self.meta["offsets"], dtype=np.int64)
+        self.X = np.memmap(path + ".X.dat", dtype=np.float32, mode="r", shape=self.shape)
+        self.y = np.memmap(path + ".y.dat", dtype=np.float32, mode="r", shape=self.shape[0])
+        self.source_rows = np.load(path + ".rows.npy", mmap_mode="r")
+
+    def __len__(self):
+        return self.shape[0]
+
+    def row_range(self, first=None, last=None):
+        """
+        Return the (start, stop) rows of the partitions whose key lies in [first, last]. None leaves a side open.
+        """
+        keys = np.array(self.keys)
+        start = 0 if first is None else np.searchsorted(keys, first, side="left")
+        stop = len(keys) if last is None else np.searchsorted(keys, last, side="right")
+        stop = max(start, stop)
+        return int(self.offsets[start]), int(self.offsets[stop])
+
+    def between(self, first=None, last=None):
+        """
+        Return (X, y) views of the rows whose key lies in [first, last], in key order
+        """
+        start, stop = self.row_range(first, last)
+        return self.X[start:stop], self.y[start:stop]
+
+    @classmethod
+    def write(cls, path, parts, partitions, chunk_rows=1 << 14, sources=None):
+        """
+        Write the rows of parts, a list of (X, y) whose rows concatenate in metadata store order, as a
+        PartitionedMatrix. partitions is a list of (key, sorted rows) into the concatenated rows, such as the months
+        and rows of the metadata store "appeared" index. Partitions are written in key order; rows in none are left out.
+        sources, the signatures of the files the parts were read from, is recorded to detect a stale store later.
+        """
+        partitions = sorted((key, np.asarray(rows, dtype=np.int64)) for key, rows in partitions if len(rows))
+        bounds = np.cumsum([0] + [len(y) for _, y in parts])
+        ncols = parts[0][0].shape[1]
+        source_rows = np.concatenate([rows for _, rows in partitions]) if partitions else np.empty(0, np.int64)
+        nrows = len(source_rows)
+
+        X_out = np.memmap(path + ".X.dat", dtype=np.float32, mode="w+", shape=(max(nrows, 1), ncols))
+        y_out = np.memmap(path + ".y.dat", dtype=np.float32, mode="w+", shape=max(nrows, 1))
+        for start, stop in chunk_ranges(nrows, chunk_rows):
+            rows = source_rows[start:stop]
+            for (X, y), lower, upper in zip(parts, bounds[:-1], bounds[1:]):
+                in_part = (rows >= lower) & (rows < upper)
+                if in_part.any():
+                    X_out[start:stop][in_part] = read_rows(X, rows=rows[in_part] - lower)
+                    y_out[start:stop][in_part] = np.asarray(y[rows[in_part] - lower], dtype=np.float32)
+        X_out.flush()
+        y_out.flush()
+        np.save(path + ".rows.npy", source_rows)
+
+        offsets = np.cumsum([0] + [len(rows) for _, rows in partitions])
+        json.dump({"shape": [nrows, ncols], "keys": [key for key, _ in partitions], "offsets": offsets.tolist(),
+                   "sources": sources}, open(path + ".json", "w"))
+        return cls(path)
+
+
+def write_labels(path, y):
+    """
+    Write the {-1, 0, 1} float32 labels y as int8
+    """
+    labels = np.memmap(path, dtype=np.int8, mode="w+", shape=len(y))
+    labels[:] = y
+    labels.flush()
+
+
+def read_labels(path):
+    return np.memmap(path, dtype=np.int8, mode="r")
+
+
+def labeled_rows(y):
+    """
+    Return the sorted indices of the labeled (y != -1) rows. For a memmapped y the index is cached next to the label
+    file and reused until the labels are rewritten.
+    """
+    path = getattr(y, "filename", None)
+    cache_path = f"{path}.labeled.npy" if path is not None else None
+    if cache_path is not None and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return np.load(cache_path, mmap_mode="r")
+
+    rows = np.concatenate([
+        start + np.flatnonzero(np.asarray(y[start:stop]) != -1) for start, stop in chunk_ranges(len(y), 1 << 22)
+    ]).astype(np.int64)
+    if cache_path is not None:
+        np.save(cache_path, rows)
+    return rows
+
+
+def read_rows(X, start=None, stop=None, rows=None):
+    """
+    Read a block of rows as float32 from either a memmapped matrix or one of the compact store readers
+    """
+    if hasattr(X, "read"):
+        return X.read(start, stop, rows)
+    return np.asarray(X[start:stop] if rows is None else X[rows], dtype=np.float32)
+
+
+class RowSequence:
+    """
+    The rows of X selected by a sorted row index, exposed through the lightgbm.Sequence interface so that LightGBM
+    samples single rows for bin construction and then pulls the rest in batches of batch_size. Only one batch of raw
+    features is in memory at a time; X can be a memmap or a compact store reader.
+    """
+
+    def __init__(self, X, rows, batch_size=1 << 16):
+        self.X = X
+        self.rows = rows
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            rows = np.asarray(self.rows[idx])
+            if len(rows) == 0:
+                return np.empty((0, self.X.shape[1]), dtype=np.float32)
+            # Labeled rows are mostly contiguous, so read the covering range and drop the unlabeled rows from it
+            start = int(rows[0])
+            return read_rows(self.X, start, int(rows[-1]) + 1)[rows - start]
+        if isinstance(idx, (list, np.ndarray)):
+            return read_rows(self.X, rows=np.asarray(self.rows)[idx])
+        # LightGBM requires the rows it samples for bin construction to be float64
+        return read_rows(self.X, rows=[int(self.rows[idx])])[0].astype(np.float64)
+
+
+def streamed_dataset(X, y, rows=None, weight=None, params=None, batch_size=1 << 16):
+    """
+    Build a lightgbm.Dataset over the labeled rows of X without copying X into memory. X can be a memmap or a compact
+    store reader. LightGBM samples bin_construct_sample_cnt single rows to find the bins, exactly as for an in-memory
+    matrix, and then pulls the rows in batches of batch_size. Peak memory is that sample plus one batch plus LightGBM's
+    binned dataset, whatever the size of X.
+
+    The dataset is constructed lazily, by lgb.train, so that dataset parameters among the training parameters (max_bin,
+    min_data_in_leaf, ...) apply. Callers also pass their training params here so that they hold for validation sets.
+    A BinnedMatrix adds its dataset_params, so that the model's thresholds are its bin bounds.
+    """
+    import lightgbm as lgb
+    lgb.Sequence.register(RowSequence)
+
+    if isinstance(X, BinnedMatrix):
+        params = {**(params or {}), **X.dataset_params}
+    if rows is None:
+        rows = labeled_rows(y)
+    label = np.asarray(y[rows], dtype=np.float32)
+    if weight is not None:
+        weight = np.asarray(weight[rows], dtype=np.float32)
+    return lgb.Dataset(RowSequence(X, rows, batch_size), label=label, weight=weight, params=params)
+
+
+def compact_paths(data_dir, feature_set="adobe", subset="train"):
+    """
+    Return the (X, y) paths of one subset of a feature set ("adobe" or "ember") in the compact store
+    """
+    suffix = "_adobe" if feature_set == "adobe" else ""
+    return (os.path.join(data_dir, f"X_{subset}{suffix}_compact"),
+            os.path.join(data_dir, f"y_{subset}{suffix}_compact.dat"))
+
+
+def read_compact_features(data_dir, feature_set="adobe", subset=None):
+    """
+    Open the compact store written by adobe.compact_vectorized_features, with the same return conventions as
+    adobe.read_vectorized_features. The X readers return float32 rows from read().
+    """
+    if subset is not None and subset not in ["train", "test"]:
+        return None
+
+    matrix_class = CompactMatrix if feature_set == "adobe" else BinnedMatrix
+    arrays = []
+    for s in ["train", "test"]:
+        if subset is None or subset == s:
+            X_path, y_path = compact_paths(data_dir, feature_set, s)
+            arrays.append(matrix_class(X_path))
+            arrays.append(read_labels(y_path))
+    return tuple(arrays)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# The header regions of many samples packed into one append-only blob file, so that rescoring a sample repository
+# reads one memmapped file instead of opening every samples_dir/{a}/{b}/{c}/{sha256}. The blob is <path>.blob and the
+# index <path>.index.npz holds the sha256 digests in sorted order with the offset and length of each header. Digests
+# are kept as raw 32 byte rows rather than NumPy "S32" strings, which drop trailing NUL bytes on comparison.
+import os
+import numpy as np
+
+
+def digest_keys(digests):
+    """
+    View (n, 32) uint8 digests as n opaque 32 byte values, which sort and compare bytewise
+    """
+    return np.ascontiguousarray(digests).view("V32").ravel()
+
+
+class HeaderPack:
+    """
+    Read access to a pack written by HeaderPack.append. Headers are zero-copy memoryviews into the memmapped blob.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index = np.load(path + ".index.npz")
+        # Indexes written with an "S32" digests array hold the same 32 bytes per row
+        self.digests = np.ascontiguousarray(index["digests"]).view(np.uint8).reshape(-1, 32)
+        self.keys = digest_keys(self.digests)
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        size = int((self.offsets + self.lengths).max(initial=0))
+        self.blob = np.memmap(path + ".blob", dtype=np.uint8, mode="r", shape=size) if size else np.empty(0, np.uint8)
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __contains__(self, sha256):
+        return self._find(sha256) >= 0
+
+    def _find(self, sha256):
+        digest = np.array(bytes.fromhex(sha256), dtype="V32")
+        i = np.searchsorted(self.keys, digest)
+        return i if i < len(self.keys) and self.keys[i] == digest else -1
+
+    def get(self, sha256):
+        """
+        Return the header of sha256, or None if it is not in the pack
+        """
+        i = self._find(sha256)
+        if i < 0:
+            return None
+        return memoryview(self.blob[self.offsets[i]:self.offsets[i] + self.lengths[i]])
+
+    def sha256s(self):
+        return [digest.tobytes().hex() for digest in self.digests]
+
+    def items(self):
+        """
+        Yield (sha256, header) in blob order, which reads the blob sequentially
+        """
+        for i in np.argsort(self.offsets, kind="stable"):
+            start = self.offsets[i]
+            yield self.digests[i].tobytes().hex(), memoryview(self.blob[start:start + self.lengths[i]])
+
+    @classmethod
+    def append(cls, path, items):
+        """
+        Append (sha256, header bytes) items to the pack at path, creating it if needed, and return the updated pack.
+        Samples already in the pack or repeated in items are skipped. The blob is only ever appended to and the index
+        is replaced atomically once the new headers are on disk.
+        """
+        if os.path.exists(path + ".index.npz"):
+            pack = cls(path)
+            digests, offsets, lengths = [pack.digests], [pack.offsets], [pack.lengths]
+            known = set(pack.sha256s())
+        else:
+            digests, offsets, lengths = [], [], []
+            known = set()
+
+        new_digests, new_offsets, new_lengths = [], [], []
+        with open(path + ".blob", "ab") as blob:
+            offset = blob.tell()
+            for sha256, header in items:
+                sha256 = sha256.lower()
+                if sha256 in known:
+                    continue
+                known.add(sha256)
+                blob.write(header)
+                new_digests.append(np.frombuffer(bytes.fromhex(sha256), dtype=np.uint8))
+                new_offsets.append(offset)
+                new_lengths.append(len(header))
+                offset += len(header)
+
+        digests = np.concatenate(digests + [np.array(new_digests, dtype=np.uint8).reshape(-1, 32)])
+        offsets = np.concatenate(offsets + [np.array(new_offsets, dtype=np.int64)])
+        lengths = np.concatenate(lengths + [np.array(new_lengths, dtype=np.int32)])
+        order = np.argsort(digest_keys(digests), kind="stable")
+        with open(path + ".index.tmp.npz", "wb") as f:
+            np.savez(f, digests=digests[order], offsets=offsets[order], lengths=lengths[order])
+        os.replace(path + ".index.tmp.npz", path + ".index.npz")
+        return cls(path)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+# Measure the cold import cost of adobe in fresh interpreters: wall time, peak RSS and number of loaded modules. The
+# eager variant first imports the training and analysis dependencies that adobe used to import at module load, which
+# is what importing it cost before they moved into the functions that use them. Run from the repository root.
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+eager_modules = ["ember", "tqdm", "pandas", "lightgbm", "sklearn.model_selection", "sklearn.metrics"]
+
+probe = """
+import sys
+import json
+import time
+import resource
+import importlib
+start = time.perf_counter()
+missing = []
+for name in {modules!r}:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        missing.append(name)
+import adobe
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(sys.modules), missing]))
+"""
+
+
+def measure(modules, runs):
+    """
+    Return the median seconds, peak RSS in MB and module count of importing modules and then adobe over runs fresh
+    interpreters, and the modules that could not be imported
+    """
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", probe.format(modules=modules)], capture_output=True, text=True,
+                                check=True).stdout
+        results.append(json.loads(output.strip().split("\n")[-1]))
+    seconds, rss_kb, nmodules = np.median([result[:3] for result in results], axis=0)
+    return seconds, rss_kb / 1024, int(nmodules), results[-1][3]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the cold import cost of adobe with eager dependency imports")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters per variant (median is reported)")
+    args = parser.parse_args()
+
+    for name, modules in [("lazy", []), ("eager", eager_modules)]:
+        seconds, rss_mb, nmodules, missing = measure(modules, args.runs)
+        note = f" (not installed: {', '.join(missing)})" if missing else ""
+        print(f"{name:6s} {seconds:.3f} s {rss_mb:.0f} MB max RSS {nmodules} modules{note}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# A columnar replacement for ember.read_metadata. Every metadata column is a memmapped file row-aligned with the
+# vectorized matrices (the train rows then the test rows), so an analysis opens the store instantly and only pages in
+# the columns it touches.
+import os
+import csv
+import json
+import numpy as np
+import feature_store
+
+
+class InvertedIndex:
+    """
+    Maps every value of a dictionary encoded column to the sorted array of rows holding it. The row ids of all values
+    are stored back to back in one memmapped file, with offsets[code]:offsets[code + 1] delimiting each value, so
+    looking up a value is a zero-copy slice.
+    """
+
+    def __init__(self, path, dictionary):
+        self.offsets = np.load(path + ".offsets.npy")
+        self.row_ids = np.memmap(path + ".rows.dat", dtype=np.int64, mode="r", shape=int(self.offsets[-1]))
+        self.dictionary = dictionary
+        self.codes = {value: code for code, value in enumerate(dictionary)}
+
+    def __len__(self):
+        return len(self.dictionary)
+
+    def rows(self, value):
+        """
+        Return the sorted rows holding value, or an empty array if it never occurs
+        """
+        code = self.codes.get(value)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        return self.row_ids[self.offsets[code]:self.offsets[code + 1]]
+
+    def rows_any(self, values):
+        """
+        Return the sorted rows holding any of values
+        """
+        return union(*[self.rows(value) for value in values])
+
+    def counts(self, rows=None):
+        """
+        Return the number of rows of each value, optionally only within a row slice such as
+        MetadataStore.subset_slice(...)
+        """
+        if rows is None:
+            return np.diff(self.offsets)
+        return np.array([
+            np.searchsorted(self.row_ids[self.offsets[code]:self.offsets[code + 1]], rows.stop) -
+            np.searchsorted(self.row_ids[self.offsets[code]:self.offsets[code + 1]], rows.start)
+            for code in range(len(self.dictionary))
+        ])
+
+    @staticmethod
+    def write(path, codes, ncodes):
+        """
+        Write the index of a column of dictionary codes
+        """
+        order = np.argsort(codes, kind="stable")
+        offsets = np.zeros(ncodes + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(codes, minlength=ncodes))
+        row_ids = np.memmap(path + ".rows.dat", dtype=np.int64, mode="w+", shape=max(len(order), 1))
+        row_ids[:len(order)] = order
+        row_ids.flush()
+        np.save(path + ".offsets.npy", offsets)
+
+
+def union(*rows):
+    """
+    Return the sorted union of sorted row arrays
+    """
+    if not rows:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(rows))
+
+
+def intersection(*rows):
+    """
+    Return the sorted intersection of sorted row arrays
+    """
+    result = rows[0]
+    for other in rows[1:]:
+        result = np.intersect1d(result, other, assume_unique=True)
+    return np.asarray(result)
+
+
+def restrict(rows, rows_slice, relative=False):
+    """
+    Return the part of the sorted rows within a row slice, such as MetadataStore.subset_slice("train"), as a
+    zero-copy view. With relative=True the rows are offset to index the vectorized matrix of that subset.
+    """
+    start, stop = np.searchsorted(rows, [rows_slice.start, rows_slice.stop])
+    rows = rows[start:stop]
+    return rows - rows_slice.start if relative else rows
+
+
+class MetadataStore:
+    """
+    Columnar, memory-mapped EMBER metadata. sha256 and md5 are stored as raw 32 and 16 byte digests, label as int8,
+    and every other column (appeared, avclass, subset, ...) is dictionary encoded: a narrowed integer code per row
+    plus the list of distinct values. Prediction columns are attached by reference to their own memmapped files
+    instead of being copied in.
+    """
+
+    digest_columns = {"sha256": 32, "md5": 16}
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(os.path.join(path, "meta.json")))
+        self.nrows = self.meta["nrows"]
+        self._columns = {}
+        self._codes = {}
+
+    def __len__(self):
+        return self.nrows
+
+    @property
+    def columns(self):
+        return list(self.meta["columns"]) + list(self.meta["attached"])
+
+    def _file(self, name):
+        return os.path.join(self.path, f"{name}.dat")
+
+    def codes(self, name):
+        """
+        Return the memmapped raw column: digests, labels or dictionary codes
+        """
+        if name not in self._columns:
+            spec = self.meta["columns"][name]
+            shape = (self.nrows, spec["width"]) if spec["kind"] == "digest" else self.nrows
+            self._columns[name] = np.memmap(self._file(name), dtype=spec["dtype"], mode="r", shape=shape)
+        return self._columns[name]
+
+    def dictionary(self, name):
+        return self.meta["columns"][name]["dictionary"]
+
+    def code(self, name, value):
+        """
+        Return the dictionary code of value in column name. A value that never occurs raises KeyError rather than
+        returning a code such as -1, which would silently index the last entry of a per-code array.
+        """
+        if name not in self._codes:
+            self._codes[name] = {value: code for code, value in enumerate(self.dictionary(name))}
+        if value not in self._codes[name]:
+            raise KeyError(f"{value!r} does not occur in column {name}")
+        return self._codes[name][value]
+
+    def subset_slice(self, subset):
+        """
+        Return the slice of rows belonging to subset ("train" or "test")
+        """
+        start, stop = self.meta["subsets"][subset]
+        return slice(start, stop)
+
+    def column(self, name, subset=None):
+        """
+        Return a column decoded to its values, optionally only for the rows of one subset. Attached columns and int8
+        labels are returned as memmaps without copying.
+        """
+        if name in self.meta["attached"]:
+            return self._attached(name, subset)
+
+        rows = slice(None) if subset is None else self.subset_slice(subset)
+        spec = self.meta["columns"][name]
+        values = self.codes(name)[rows]
+        if spec["kind"] == "digest":
+            return np.array([row.tobytes().hex() for row in values])
+        if spec["kind"] == "category":
+            return np.asarray(spec["dictionary"], dtype=object)[values]
+        return values
+
+    def attach(self, name, paths, dtype="float32"):
+        """
+        Attach a prediction column by reference. paths maps each subset to a memmapped file with one value per row of
+        that subset, e.g. {"train": "y_train_pred.dat", "test": "y_test_pred.dat"}. Relative paths are relative to the
+        store.
+        """
+        self.meta["attached"][name] = {"paths": paths, "dtype": dtype}
+        self._columns.pop(name, None)
+        json.dump(self.meta, open(os.path.join(self.path, "meta.json"), "w"))
+
+    def _attached(self, name, subset):
+        spec = self.meta["attached"][name]
+        arrays = []
+        for s in ([subset] if subset is not None else list(self.meta["subsets"])):
+            start, stop = self.meta["subsets"][s]
+            path = os.path.join(self.path, spec["paths"][s])
+            arrays.append(np.memmap(path, dtype=spec["dtype"], mode="r", shape=stop - start))
+        return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+    def index(self, name):
+        """
+        Return the InvertedIndex of a dictionary encoded column, building and persisting it on first use. The
+        "appeared" index maps each month to its rows.
+        """
+        if ("index", name) not in self._columns:
+            path = os.path.join(self.path, f"{name}.index")
+            if not os.path.exists(path + ".offsets.npy"):
+                InvertedIndex.write(path, np.asarray(self.codes(name)), len(self.dictionary(name)))
+            self._columns[("index", name)] = InvertedIndex(path, self.dictionary(name))
+        return self._columns[("index", name)]
+
+    def rows_between(self, name, first, last):
+        """
+        Return the sorted rows whose value of name lies in [first, last], e.g. the "appeared" months from "2018-01"
+        to "2018-06"
+        """
+        index = self.index(name)
+        return index.rows_any([value for value in index.dictionary if first <= value <= last])
+
+    def to_frame(self, columns, subset=None):
+        """
+        Build a pandas DataFrame of only the requested columns
+        """
+        import pandas as pd
+        return pd.DataFrame({name: self.column(name, subset) for name in columns})
+
+    @classmethod
+    def write(cls, path, csv_path):
+        """
+        Convert an EMBER metadata.csv to a MetadataStore in one streaming pass over the file
+        """
+        os.makedirs(path, exist_ok=True)
+        # Indexes are built on first use from the columns written here, so those of an earlier store are stale
+        for name in os.listdir(path):
+            if ".index." in name:
+                os.remove(os.path.join(path, name))
+        reader = csv.DictReader(open(csv_path, newline=""))
+        names = [name for name in reader.fieldnames if name]
+
+        values = {name: [] for name in names}
+        dictionaries = {name: {} for name in names}
+        for record in reader:
+            for name in names:
+                value = record[name]
+                if name in cls.digest_columns:
+                    values[name].append(bytes.fromhex(value) if value else bytes(cls.digest_columns[name]))
+                elif name == "label":
+                    values[name].append(int(float(value)))
+                else:
+                    values[name].append(dictionaries[name].setdefault(value, len(dictionaries[name])))
+
+        nrows = len(values[names[0]]) if names else 0
+        meta = {"nrows": nrows, "columns": {}, "attached": {}, "subsets": {}}
+        for name in names:
+            if name in cls.digest_columns:
+                array = np.frombuffer(b"".join(values[name]), dtype=np.uint8).reshape(nrows, -1)
+                meta["columns"][name] = {"kind": "digest", "dtype": "uint8", "width": cls.digest_columns[name]}
+            elif name == "label":
+                array = np.array(values[name], dtype=np.int8)
+                meta["columns"][name] = {"kind": "label", "dtype": "int8"}
+            else:
+                dtype = feature_store.narrowest_dtype(0, max(len(dictionaries[name]) - 1, 0))
+                array = np.array(values[name], dtype=dtype)
+                meta["columns"][name] = {"kind": "category", "dtype": dtype.name,
+                                         "dictionary": list(dictionaries[name])}
+            column = np.memmap(os.path.join(path, f"{name}.dat"), dtype=array.dtype, mode="w+", shape=array.shape)
+            column[:] = array
+            column.flush()
+
+        # The vectorized matrices hold the rows of each subset contiguously and in metadata order
+        if "subset" in dictionaries:
+            codes = np.array(values["subset"])
+            for subset, code in dictionaries["subset"].items():
+                rows = np.flatnonzero(codes == code)
+                if len(rows) != rows[-1] - rows[0] + 1:
+                    raise Exception(f"The {subset} rows of {csv_path} are not contiguous")
+                meta["subsets"][subset] = [int(rows[0]), int(rows[-1]) + 1]
+
+        json.dump(meta, open(os.path.join(path, "meta.json"), "w"))
+        return cls(path)
+
+
+def create_metadata_store(data_dir):
+    """
+    Write the MetadataStore for data_dir/metadata.csv to data_dir/metadata
+    """
+    return MetadataStore.write(os.path.join(data_dir, "metadata"), os.path.join(data_dir, "metadata.csv"))
+
+
+def read_metadata_store(data_dir):
+    """
+    Open the MetadataStore of data_dir, creating it from metadata.csv the first time
+    """
+    path = os.path.join(data_dir, "metadata")
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return create_metadata_store(data_dir)
+    return MetadataStore(path)
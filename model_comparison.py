@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+import feature_store
+import model_registry
+
+
+class StreamingComparison:
+    """
+    Accumulates, chunk by chunk, everything needed to compare several models scored on the same rows: per model score
+    histograms by label for ROC curves, pairwise max and mean absolute prediction differences, and a compact uint16
+    score code per row and model from which verdict flips at any FPR are counted once the thresholds are known.
+
+    Scores are binned on the logit scale so that the bins stay fine in the low FPR region near a score of 1.0.
+    """
+
+    nbins = 1 << 16
+    logit_range = 21.0
+
+    def __init__(self, names, nrows):
+        self.names = list(names)
+        nmodels = len(self.names)
+        self.histograms = np.zeros((nmodels, 2, self.nbins), dtype=np.int64)
+        self.max_diff = np.zeros((nmodels, nmodels))
+        self.sum_diff = np.zeros((nmodels, nmodels))
+        self.codes = np.zeros((nrows, nmodels), dtype=np.uint16)
+        self.nrows = 0
+
+    @classmethod
+    def score_codes(cls, y_pred):
+        p = np.clip(y_pred, 1e-9, 1 - 1e-9)
+        logit = np.log(p) - np.log1p(-p)
+        scaled = (logit + cls.logit_range) / (2 * cls.logit_range) * (cls.nbins - 1)
+        return np.clip(scaled, 0, cls.nbins - 1).astype(np.uint16)
+
+    @classmethod
+    def code_score(cls, code):
+        """
+        Return the smallest score that maps to code
+        """
+        logit = code / (cls.nbins - 1) * (2 * cls.logit_range) - cls.logit_range
+        return 1.0 / (1.0 + np.exp(-logit))
+
+    def update(self, start, y_preds, y):
+        """
+        Add the (nrows, nmodels) predictions of the rows starting at start with labels y (-1 for unlabeled)
+        """
+        codes = self.score_codes(y_preds)
+        self.codes[start:start + len(codes)] = codes
+        for label in [0, 1]:
+            labeled = codes[y == label]
+            for imodel in range(len(self.names)):
+                self.histograms[imodel, label] += np.bincount(labeled[:, imodel], minlength=self.nbins)
+        for imodel in range(len(self.names)):
+            diff = np.abs(y_preds - y_preds[:, imodel:imodel + 1])
+            self.max_diff[imodel] = np.maximum(self.max_diff[imodel], diff.max(axis=0, initial=0.0))
+            self.sum_diff[imodel] += diff.sum(axis=0)
+        self.nrows += len(codes)
+
+    def roc_curves(self):
+        """
+        Return (fpr, tpr) arrays of shape (nmodels, nbins + 1) for thresholds from above the top bin down to bin 0
+        """
+        counts = np.cumsum(self.histograms[:, :, ::-1], axis=2)
+        counts = np.concatenate((np.zeros(counts.shape[:2] + (1, ), dtype=np.int64), counts), axis=2)
+        totals = np.maximum(counts[:, :, -1:], 1)
+        rates = counts / totals
+        return rates[:, 0], rates[:, 1]
+
+    def summary(self, fpr_target):
+        """
+        Return the per model and pairwise comparison at fpr_target as a dictionary of arrays
+        """
+        fpr, tpr = self.roc_curves()
+        auc = np.trapezoid(tpr, fpr, axis=1) if hasattr(np, "trapezoid") else np.trapz(tpr, fpr, axis=1)
+
+        # The threshold of each model is the lowest bin that keeps its FPR at or below the target
+        ithreshold = np.array([np.flatnonzero(f <= fpr_target).max() for f in fpr])
+        threshold_codes = self.nbins - ithreshold
+        verdicts = self.codes[:self.nrows] >= threshold_codes
+        flips = np.array([(verdicts != verdicts[:, [imodel]]).sum(axis=0) for imodel in range(len(self.names))])
+
+        return {
+            "names": self.names,
+            "auc": auc,
+            "threshold": self.code_score(threshold_codes),
+            "fpr": fpr[np.arange(len(self.names)), ithreshold],
+            "tpr": tpr[np.arange(len(self.names)), ithreshold],
+            "max_diff": self.max_diff,
+            "mean_diff": self.sum_diff / max(self.nrows, 1),
+            "flips": flips,
+        }
+
+
+def compare_models(X, y, models, names=None, fpr_target=1e-2, chunk_rows=1 << 15):
+    """
+    Stream X once in chunks of chunk_rows through every model and return StreamingComparison.summary. models are
+    LightGBM Boosters or model file paths, which are loaded through model_registry. X can be a memmap or a compact
+    store reader.
+    """
+    if names is None:
+        names = [os.path.basename(m) if isinstance(m, str) else f"model{i}" for i, m in enumerate(models)]
+    models = [model_registry.load_booster(m) if isinstance(m, str) else m for m in models]
+
+    comparison = StreamingComparison(names, len(y))
+    for start, stop in feature_store.chunk_ranges(len(y), chunk_rows):
+        X_chunk = feature_store.read_rows(X, start, stop)
+        y_preds = np.column_stack([model.predict(X_chunk) for model in models])
+        comparison.update(start, y_preds, np.asarray(y[start:stop]))
+    return comparison.summary(fpr_target)
+
+
+def prediction_latency(model, X, nsamples=1000, seed=0):
+    """
+    Return the median seconds of a single-row prediction, as an inline scanner scoring one file at a time would make,
+    and the seconds per row of one batch prediction over the same nsamples random rows of X. model is a Booster or a
+    model file path; LightGBM is pinned to one thread for both.
+    """
+    import time
+
+    if isinstance(model, str):
+        model = model_registry.load_booster(model)
+    rows = np.sort(np.random.default_rng(seed).choice(len(X), min(nsamples, len(X)), replace=False))
+    X_sample = feature_store.read_rows(X, rows=rows)
+    timings = np.empty(len(X_sample))
+    for i in range(len(X_sample)):
+        start = time.perf_counter()
+        model.predict(X_sample[i:i + 1], num_threads=1)
+        timings[i] = time.perf_counter() - start
+    start = time.perf_counter()
+    model.predict(X_sample, num_threads=1)
+    return float(np.median(timings)), (time.perf_counter() - start) / max(len(X_sample), 1)
+
+
+def write_comparison_table(summary, path, reference=0):
+    """
+    Write one tab separated row per model with its ROC statistics and its differences from the reference model
+    """
+    ref = summary["names"][reference]
+    header = ["model", "auc", "threshold", "fpr", "tpr", f"max_diff_vs_{ref}", f"mean_diff_vs_{ref}", f"flips_vs_{ref}"]
+    with open(path, "w") as f:
+        f.write("\t".join(header) + "\n")
+        for i, name in enumerate(summary["names"]):
+            row = [
+                name, f"{summary['auc'][i]:.6f}", f"{summary['threshold'][i]:.6f}", f"{summary['fpr'][i]:.6f}",
+                f"{summary['tpr'][i]:.6f}", f"{summary['max_diff'][reference, i]:.6f}",
+                f"{summary['mean_diff'][reference, i]:.6f}", f"{summary['flips'][reference, i]}"
+            ]
+            f.write("\t".join(row) + "\n")
+
+
+def compare_random_models(data_dir, nmodels=10, fpr_target=1e-2):
+    """
+    Compare the official EMBER model with the models from adobe.train_multiple on the test set in one pass
+    """
+    import ember
+
+    X_test, y_test = ember.read_vectorized_features(data_dir, "test")
+    models = [os.path.join(data_dir, "ember_model_2018.txt")]
+    models += [os.path.join(data_dir, f"ember_model_2018_random{i}.txt") for i in range(nmodels)]
+    summary = compare_models(X_test, y_test, models, fpr_target=fpr_target)
+    write_comparison_table(summary, os.path.join(data_dir, "model_comparison.tsv"))
+    print(f"Maximum prediction difference: {summary['max_diff'].max()}")
+    return summary
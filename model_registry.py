@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+# LightGBM text models compiled once into flat NumPy arrays, stored as .npy files under a directory named by the
+# sha256 of the model file. Loading a compiled model is a handful of np.load(mmap_mode="r") calls instead of parsing
+# a multi-megabyte text file, and every process that loads it, forked or not, shares the same page cache pages.
+import os
+import json
+import hashlib
+import numpy as np
+
+tree_keys = {
+    "split_feature": np.int32, "threshold": np.float64, "decision_type": np.int8, "left_child": np.int32,
+    "right_child": np.int32, "leaf_value": np.float64
+}
+array_names = ["node_offsets", "leaf_offsets", "split_feature", "threshold", "decision_type", "left_child",
+               "right_child", "leaf_value"]
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def parse_model_file(path):
+    """
+    Return the header fields and the list of tree dictionaries of a LightGBM text model file
+    """
+    header = {}
+    trees = []
+    tree = None
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("Tree="):
+                tree = {}
+                trees.append(tree)
+            elif line == "end of trees":
+                break
+            elif "=" in line:
+                key, _, value = line.partition("=")
+                if tree is None:
+                    header[key] = value
+                elif key in tree_keys:
+                    tree[key] = np.array(value.split(), dtype=tree_keys[key])
+                elif key in ["num_leaves", "num_cat", "is_linear"]:
+                    tree[key] = int(value)
+                elif key == "shrinkage":
+                    tree[key] = float(value)
+    return header, trees
+
+
+class CompiledModel:
+    """
+    A binary LightGBM model: the nodes of all trees concatenated into flat arrays. Child indexes are global, with
+    leaves encoded as ~(global leaf index). Rows are routed through a block of trees at once, one tree level per step.
+    Only numerical splits are supported, with LightGBM's missing value handling.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(os.path.join(path, "meta.json")))
+        for name in array_names:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        self.num_trees = len(self.node_offsets) - 1
+        self.num_feature = self.meta["num_feature"]
+        self.sigmoid = self.meta["sigmoid"]
+
+    @classmethod
+    def compile(cls, model_file, path):
+        """
+        Compile a LightGBM text model file to a CompiledModel directory at path
+        """
+        header, trees = parse_model_file(model_file)
+        if header.get("num_class", "1") != "1":
+            raise Exception(f"Only single class models can be compiled, {model_file} is not one")
+        for tree in trees:
+            if tree.get("num_cat", 0) or tree.get("is_linear", 0):
+                raise Exception(f"{model_file} has categorical splits or linear trees, which cannot be compiled")
+
+        num_nodes = np.array([len(tree.get("split_feature", [])) for tree in trees])
+        num_leaves = np.array([tree["num_leaves"] for tree in trees])
+        node_offsets = np.concatenate(([0], np.cumsum(num_nodes))).astype(np.int64)
+        leaf_offsets = np.concatenate(([0], np.cumsum(num_leaves))).astype(np.int64)
+
+        def global_child(child, itree):
+            return np.where(child >= 0, child + node_offsets[itree], ~(~child + leaf_offsets[itree]))
+
+        arrays = {
+            "node_offsets": node_offsets,
+            "leaf_offsets": leaf_offsets,
+            "leaf_value": np.concatenate([tree["leaf_value"] for tree in trees]),
+        }
+        for name in ["split_feature", "threshold", "decision_type"]:
+            arrays[name] = np.concatenate([tree.get(name, np.empty(0, tree_keys[name])) for tree in trees])
+        for name in ["left_child", "right_child"]:
+            arrays[name] = np.concatenate([
+                global_child(tree.get(name, np.empty(0, np.int32)), itree) for itree, tree in enumerate(trees)
+            ]).astype(np.int64)
+
+        objective = header.get("objective", "").split()
+        sigmoid = None
+        if objective and objective[0] == "binary":
+            sigmoid = float(dict(o.split(":") for o in objective[1:] if ":" in o).get("sigmoid", 1.0))
+        elif objective and objective[0] in ["cross_entropy", "xentropy"]:
+            # Models trained on soft labels, such as distilled ones, output the logistic of the raw score
+            sigmoid = 1.0
+        meta = {"source": os.path.abspath(model_file), "num_feature": int(header["max_feature_idx"]) + 1,
+                "sigmoid": sigmoid}
+
+        # Write to a temporary directory first so that concurrent loaders never see a partial model
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in array_names:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), arrays[name])
+        json.dump(meta, open(os.path.join(tmp_path, "meta.json"), "w"))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process compiled the same model first
+            for name in os.listdir(tmp_path):
+                os.remove(os.path.join(tmp_path, name))
+            os.rmdir(tmp_path)
+        return cls(path)
+
+    def _decide(self, x, nodes):
+        """
+        Return the next node of every (row value, node) pair, following LightGBM's NumericalDecision
+        """
+        decision_type = self.decision_type[nodes]
+        missing_type = (decision_type >> 2) & 3
+        is_nan = np.isnan(x)
+        x = np.where(is_nan & (missing_type != 2), 0.0, x)
+        missing = ((missing_type == 1) & (np.abs(x) <= 1e-35)) | ((missing_type == 2) & is_nan)
+        go_left = np.where(missing, (decision_type & 2) != 0, x <= self.threshold[nodes])
+        return np.where(go_left, self.left_child[nodes], self.right_child[nodes])
+
+    def predict(self, X, raw_score=False, chunk_rows=8192, tree_block=64):
+        """
+        Return the predictions for the rows of X, like lightgbm.Booster.predict
+        """
+        raw = np.zeros(len(X), dtype=np.float64)
+        for start in range(0, len(X), chunk_rows):
+            X_chunk = np.asarray(X[start:start + chunk_rows], dtype=np.float64)
+            nrows = len(X_chunk)
+            for first_tree in range(0, self.num_trees, tree_block):
+                trees = np.arange(first_tree, min(first_tree + tree_block, self.num_trees))
+                # Trees without splits are a single leaf
+                roots = np.where(self.node_offsets[trees + 1] > self.node_offsets[trees], self.node_offsets[trees],
+                                 ~self.leaf_offsets[trees])
+                nodes = np.tile(roots, nrows)
+                rows = np.repeat(np.arange(nrows), len(trees))
+                active = np.flatnonzero(nodes >= 0)
+                while len(active):
+                    current = nodes[active]
+                    x = X_chunk[rows[active], self.split_feature[current]]
+                    nodes[active] = self._decide(x, current)
+                    active = active[nodes[active] >= 0]
+                raw[start:start + nrows] += self.leaf_value[~nodes].reshape(nrows, len(trees)).sum(axis=1)
+        if raw_score or self.sigmoid is None:
+            return raw
+        return 1.0 / (1.0 + np.exp(-self.sigmoid * raw))
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of compiled models keyed by the path of their source text model. A model file is hashed and
+    compiled only the first time its content is seen; afterwards the compiled arrays are memmapped. Each get checks
+    the file's size and mtime, so a replaced model file is picked up on the next call without restarting.
+
+    The compiled models load fastest, but LightGBM itself predicts faster on shallow, balanced trees such as the
+    EMBER models, so get_booster caches parsed lightgbm.Boosters the same way for throughput-bound scoring.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.models = {}
+        self.boosters = {}
+
+    def compiled_path(self, model_file, sha256):
+        cache_dir = self.cache_dir or os.path.join(os.path.dirname(os.path.abspath(model_file)), "compiled_models")
+        return os.path.join(cache_dir, sha256)
+
+    def get(self, model_file):
+        """
+        Return the CompiledModel of model_file, compiling it if its current content has not been compiled before
+        """
+        stat = os.stat(model_file)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self.models.get(model_file)
+        if cached is not None and cached[0] == signature:
+            return cached[2]
+
+        sha256 = file_sha256(model_file)
+        if cached is not None and cached[1] == sha256:
+            model = cached[2]
+        else:
+            path = self.compiled_path(model_file, sha256)
+            if os.path.exists(os.path.join(path, "meta.json")):
+                model = CompiledModel(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                model = CompiledModel.compile(model_file, path)
+        self.models[model_file] = (signature, sha256, model)
+        return model
+
+    def get_booster(self, model_file):
+        """
+        Return a lightgbm.Booster of model_file, parsed once per process and again only when the file changes
+        """
+        import lightgbm as lgb
+
+        stat = os.stat(model_file)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self.boosters.get(model_file)
+        if cached is None or cached[0] != signature:
+            cached = (signature, lgb.Booster(model_file=model_file))
+            self.boosters[model_file] = cached
+        return cached[1]
+
+
+_registry = ModelRegistry()
+
+
+def load_model(model_file):
+    """
+    Return the CompiledModel of a LightGBM text model file from the process-wide registry. Workers forked after a
+    model was loaded inherit it; other processes memmap the same compiled files.
+
+    This is opt-in for small models where loading and sharing dominate, such as many short-lived workers or a hot
+    reloaded scorer. It predicts several times slower than LightGBM, so throughput paths use load_booster.
+    """
+    return _registry.get(model_file)
+
+
+def load_booster(model_file):
+    """
+    Return the lightgbm.Booster of a model file from the process-wide registry
+    """
+    return _registry.get_booster(model_file)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# A small artifact-cached DAG runner. Each stage declares the files it reads and writes, its parameters and the code it
+# runs. A stage is skipped when the fingerprint of those (input file contents, parameters, code source) matches the one
+# recorded after its last successful run and its outputs are untouched since, so rerunning after a change only pays
+# for the stages it reaches. Stages that do not depend on each other run concurrently in forked processes.
+import os
+import ast
+import json
+import inspect
+import textwrap
+import importlib
+import hashlib
+import marshal
+import multiprocessing
+import multiprocessing.connection
+import model_registry
+
+
+def local_modules(code):
+    """
+    Return the modules next to the source files of code, a list of functions or modules, that it imports or refers
+    to, directly or through those modules, in name order. Imports inside functions count.
+    """
+    found = {}
+    stack = list(code)
+    while stack:
+        item = stack.pop()
+        try:
+            tree = ast.parse(textwrap.dedent(inspect.getsource(item)))
+            directory = os.path.dirname(os.path.abspath(inspect.getsourcefile(item)))
+        except (OSError, TypeError):
+            continue
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names.add(node.module.split(".")[0])
+            elif isinstance(node, ast.Name) and not inspect.ismodule(item):
+                names.add(node.id)
+        for name in sorted(names - set(found)):
+            if os.path.exists(os.path.join(directory, name + ".py")):
+                found[name] = importlib.import_module(name)
+                stack.append(found[name])
+    return [found[name] for name in sorted(found)]
+
+
+class Stage:
+    """
+    One step of a Pipeline: function(*args, **params) reads the files inputs and writes the files outputs, which must
+    list every file it writes, caches included. Stages that produce an input of this one run before it. code lists the
+    functions or modules whose source is part of the fingerprint, the function itself by default; the modules of this
+    repository that they use are always added, so that a change to a helper module reruns the stages that call it.
+    """
+
+    def __init__(self, name, function, inputs=(), outputs=(), args=(), params=None, code=None):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.args = tuple(args)
+        self.params = dict(params or {})
+        code = [function] if code is None else list(code)
+        self.code = code + [module for module in local_modules(code) if module not in code]
+
+    def run(self):
+        return self.function(*self.args, **self.params)
+
+
+def run_stage(stage, connection):
+    """
+    Run a stage in a worker process and send the parent None, or the error message naming the stage
+    """
+    try:
+        stage.run()
+        connection.send(None)
+    except Exception as e:
+        connection.send(f"Stage {stage.name} failed: {type(e).__name__}: {e}")
+    connection.close()
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class Pipeline:
+    """
+    A DAG of Stages with their run state kept in state_dir. Content hashes of input files are cached by (size, mtime),
+    so unchanged multi-gigabyte inputs are hashed once, and a stage whose rerun rewrote an output with the same
+    content does not invalidate the stages after it.
+    """
+
+    def __init__(self, stages, state_dir):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_dir = state_dir
+        self.producers = {}
+        for stage in stages:
+            for path in stage.outputs:
+                if path in self.producers:
+                    raise Exception(f"{path} is an output of both {self.producers[path]} and {stage.name}")
+                self.producers[path] = stage.name
+        self.dependencies = {
+            stage.name: sorted({self.producers[path] for path in stage.inputs if path in self.producers})
+            for stage in stages
+        }
+        self.order = self.topological_order()
+
+        os.makedirs(state_dir, exist_ok=True)
+        self.hashes_path = os.path.join(state_dir, "file_hashes.json")
+        self.hashes = json.load(open(self.hashes_path)) if os.path.exists(self.hashes_path) else {}
+
+    def topological_order(self):
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise Exception(f"Pipeline stages form a cycle: {' -> '.join(path + [name])}")
+            state[name] = "visiting"
+            for dependency in self.dependencies[name]:
+                visit(dependency, path + [name])
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.stages:
+            visit(name, [])
+        return order
+
+    def file_hash(self, path):
+        """
+        Return the sha256 of the contents of path, reusing the cached hash while its size and mtime are unchanged
+        """
+        signature = file_signature(path)
+        cached = self.hashes.get(path)
+        if cached is None or cached[0] != signature:
+            cached = [signature, model_registry.file_sha256(path)]
+            self.hashes[path] = cached
+            json.dump(self.hashes, open(self.hashes_path, "w"))
+        return cached[1]
+
+    @staticmethod
+    def code_hash(code):
+        sha256 = hashlib.sha256()
+        for item in code:
+            try:
+                sha256.update(inspect.getsource(item).encode())
+            except (OSError, TypeError):
+                # Functions defined interactively have no source file, but their bytecode changes with them
+                sha256.update(marshal.dumps(item.__code__))
+        return sha256.hexdigest()
+
+    def fingerprint(self, name):
+        """
+        Return the fingerprint of a stage's current inputs, parameters and code, or None if an input is missing
+        """
+        stage = self.stages[name]
+        if not all(os.path.exists(path) for path in stage.inputs):
+            return None
+        description = {
+            "inputs": {path: self.file_hash(path) for path in stage.inputs},
+            "args": [repr(arg) for arg in stage.args],
+            "params": json.dumps(stage.params, sort_keys=True, default=repr),
+            "code": self.code_hash(stage.code),
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def state_path(self, name):
+        return os.path.join(self.state_dir, f"{name}.json")
+
+    def is_current(self, name):
+        """
+        Return whether a stage's recorded fingerprint matches its inputs and its outputs are those it last wrote
+        """
+        if not os.path.exists(self.state_path(name)):
+            return False
+        state = json.load(open(self.state_path(name)))
+        for path in self.stages[name].outputs:
+            if not os.path.exists(path) or state["outputs"].get(path) != file_signature(path):
+                return False
+        return state["fingerprint"] == self.fingerprint(name)
+
+    def record(self, name):
+        stage = self.stages[name]
+        for path in stage.outputs:
+            if not os.path.exists(path):
+                raise Exception(f"Stage {name} did not write its output {path}")
+        outputs = {path: file_signature(path) for path in stage.outputs}
+        json.dump({"fingerprint": self.fingerprint(name), "outputs": outputs}, open(self.state_path(name), "w"))
+
+    def needed(self, targets=None):
+        """
+        Return the stages needed for targets (every stage by default), in order
+        """
+        needed = set()
+        stack = list(self.stages) if targets is None else list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack += self.dependencies[name]
+        return [name for name in self.order if name in needed]
+
+    def plan(self, targets=None, force=()):
+        """
+        Return the stages that a run for targets would start with, in order: the stale ones, those in force and every
+        stage after them. Stages after a rerun are actually checked again once it finishes, so fewer may run.
+        """
+        stale = set()
+        for name in self.needed(targets):
+            if (name in force or any(dependency in stale for dependency in self.dependencies[name]) or
+                    not self.is_current(name)):
+                stale.add(name)
+        return [name for name in self.order if name in stale]
+
+    def run(self, targets=None, force=(), processes=1):
+        """
+        Run the stages needed for targets, up to processes at a time, and return the names of those that ran. Each
+        stage is checked once the stages it depends on have finished and is skipped if it is current, unless it is
+        named in force. A failure stops new stages from starting and is raised once the running ones finish; the
+        stages that completed are recorded and are not rerun next time.
+
+        Every stage runs in its own forked, non-daemonic process, so that stages can start worker pools of their own.
+        """
+        context = multiprocessing.get_context("fork")
+        pending = self.needed(targets)
+        running = {}
+        ran = []
+        failure = None
+        processes = max(processes, 1)
+        while pending or running:
+            ready = [] if failure is not None else [
+                name for name in pending
+                if not any(dependency in pending or dependency in running for dependency in self.dependencies[name])
+            ]
+            for name in ready:
+                if len(running) == processes:
+                    break
+                pending.remove(name)
+                if name not in force and self.is_current(name):
+                    print(f"Stage {name} is up to date")
+                    continue
+                print(f"Running stage {name}")
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=run_stage, args=(self.stages[name], sender), name=f"stage-{name}")
+                process.start()
+                sender.close()
+                running[name] = (process, receiver)
+            if not running:
+                if failure is not None or not ready:
+                    break
+                continue
+
+            # A stage's pipe becomes readable when it reports back, or at end of file if its process died
+            receivers = {receiver: name for name, (_, receiver) in running.items()}
+            for receiver in multiprocessing.connection.wait(list(receivers)):
+                name = receivers[receiver]
+                process, _ = running.pop(name)
+                try:
+                    error = receiver.recv()
+                    process.join()
+                except EOFError:
+                    process.join()
+                    error = f"Stage {name} failed: its process exited with code {process.exitcode}"
+                receiver.close()
+                if error is not None:
+                    failure = failure or Exception(error)
+                    continue
+                self.record(name)
+                ran.append(name)
+
+        if failure is not None:
+            raise failure
+        return ran
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# Readers for EMBER raw feature JSONL that is plain, gzip (.gz) or zstd (.zst) compressed. A compressed file is read
+# as a sequence of independent frames (gzip members or zstd frames), so a file written by compress_raw_features with
+# many small frames can be entered at any frame boundary. The byte offset and first line of every frame are kept in a
+# <path>.index.v2.npy next to the file, which makes line counts free and lets workers each decompress their own shard.
+# Indexes of files in read-only locations go to index_cache_dir instead.
+import os
+import zlib
+import hashlib
+import queue
+import threading
+import numpy as np
+
+codecs = {".gz": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+read_size = 1 << 20
+# v2 indexes count a last line that has no trailing newline; older .index.npy files did not and are not read
+index_suffix = ".index.v2.npy"
+index_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "raw_feature_io")
+
+# Indexes that could not be saved anywhere, by path, with the mtime of the file they index
+_indexes = {}
+
+
+def codec(path):
+    return codecs.get(os.path.splitext(path)[1], "plain")
+
+
+def find_raw_feature_path(path):
+    """
+    Return path, or the first of its compressed variants that exists
+    """
+    for candidate in [path, path + ".zst", path + ".gz"]:
+        if os.path.exists(candidate):
+            return candidate
+    raise Exception(f"Neither {path} nor a compressed copy of it exists")
+
+
+def is_raw_feature_path(path):
+    return path.endswith((".jsonl", ".jsonl.gz", ".jsonl.zst", ".jsonl.zstd"))
+
+
+def decompressor(codec_name):
+    if codec_name == "gzip":
+        return zlib.decompressobj(wbits=31)
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("Reading .zst raw features requires the zstandard package")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def decompressed_blocks(path, offset=0):
+    """
+    Yield (frame_offset, data) blocks of the decompressed contents of path starting at the frame boundary offset,
+    where frame_offset is the compressed offset of the frame that data belongs to
+    """
+    codec_name = codec(path)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        if codec_name == "plain":
+            for data in iter(lambda: f.read(read_size), b""):
+                yield offset, data
+                offset += len(data)
+            return
+
+        pending = b""
+        frame = None
+        while True:
+            if not pending:
+                pending = f.read(read_size)
+                if not pending:
+                    break
+            if frame is None:
+                # gzip writers may pad the end of the file with zeros
+                if not pending.strip(b"\0"):
+                    pending = b""
+                    continue
+                frame = decompressor(codec_name)
+                frame_offset = offset
+            data = frame.decompress(pending)
+            if frame.eof:
+                used = len(pending) - len(frame.unused_data)
+                pending = frame.unused_data
+                frame = None
+            else:
+                used = len(pending)
+                pending = b""
+            offset += used
+            yield frame_offset, data
+
+
+def build_index(path):
+    """
+    Scan path once and return the (nentries + 1, 2) array of (byte offset, first line) of every entry point: frame
+    starts of a compressed file and roughly every read_size bytes of a plain one. The last row is (file size, total
+    lines). Frames that start in the middle of a line are not entry points.
+    """
+    entries = []
+    nlines = 0
+    at_line_start = True
+    last_offset = -1
+    for frame_offset, data in decompressed_blocks(path):
+        if codec(path) == "plain":
+            # Enter plain files just after the last newline of each block
+            if at_line_start:
+                entries.append((frame_offset, nlines))
+            end = data.rfind(b"\n")
+            if 0 <= end < len(data) - 1:
+                entries.append((frame_offset + end + 1, nlines + data.count(b"\n")))
+        elif frame_offset != last_offset and at_line_start:
+            entries.append((frame_offset, nlines))
+        last_offset = frame_offset
+        if data:
+            nlines += data.count(b"\n")
+            at_line_start = data.endswith(b"\n")
+    if not at_line_start:
+        # The last line has no trailing newline but is still a line, as for open(path) and ember's reader
+        nlines += 1
+    index = np.array(entries + [(os.path.getsize(path), nlines)], dtype=np.int64).reshape(-1, 2)
+    _, first = np.unique(index[:, 0], return_index=True)
+    return index[first]
+
+
+def index_paths(path):
+    """
+    Return where the index of path is kept: next to it, or in index_cache_dir under a name unique to its location
+    """
+    name = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16] + "_" + os.path.basename(path)
+    return [path + index_suffix, os.path.join(index_cache_dir, name + index_suffix)]
+
+
+def read_index(path):
+    """
+    Return the entry point index of path, building it if it is missing or older than path. A new index is saved next
+    to path, or in index_cache_dir if that fails, as on a read-only archive mount, or else kept in memory for this
+    process and the workers it forks.
+    """
+    mtime = os.path.getmtime(path)
+    for index_path in index_paths(path):
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= mtime:
+            return np.load(index_path)
+    if path in _indexes and _indexes[path][0] == mtime:
+        return _indexes[path][1]
+
+    index = build_index(path)
+    for index_path in index_paths(path):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+            np.save(index_path, index)
+            return index
+        except OSError:
+            continue
+    _indexes[path] = (mtime, index)
+    return index
+
+
+def count_lines(paths):
+    return sum(int(read_index(path)[-1, 1]) for path in paths)
+
+
+def iter_lines(path, start=0, stop=None):
+    """
+    Yield lines start to stop of path as bytes, decompressing from the last entry point at or before start
+    """
+    index = read_index(path)
+    stop = int(index[-1, 1]) if stop is None else stop
+    entry = max(np.searchsorted(index[:, 1], start, side="right") - 1, 0)
+    iline = int(index[entry, 1])
+    if start >= stop:
+        return
+
+    remainder = b""
+    for _, data in decompressed_blocks(path, int(index[entry, 0])):
+        lines = (remainder + data).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            if iline >= start:
+                yield line
+            iline += 1
+            if iline >= stop:
+                return
+    if remainder and start <= iline < stop:
+        yield remainder
+
+
+def shards(paths, nshards):
+    """
+    Split the lines of paths into about nshards (path, start, stop, first_row) pieces that each begin at an entry
+    point, so no worker decompresses data that another one reads. first_row is the row of the piece across all paths.
+    """
+    indexes = [read_index(path) for path in paths]
+    shard_lines = max(sum(int(index[-1, 1]) for index in indexes) // max(nshards, 1), 1)
+    pieces = []
+    first_row = 0
+    for path, index in zip(paths, indexes):
+        starts = index[:-1, 1]
+        bounds = [0]
+        for start in starts[1:]:
+            if start - bounds[-1] >= shard_lines:
+                bounds.append(int(start))
+        bounds.append(int(index[-1, 1]))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if stop > start:
+                pieces.append((path, start, stop, first_row + start))
+        first_row += int(index[-1, 1])
+    return pieces
+
+
+def raw_feature_iterator(paths, prefetch=64):
+    """
+    Yield every line of paths as a string, like ember.raw_feature_iterator, but for plain or compressed files. A
+    background thread decompresses ahead into a queue of prefetch blocks of lines while the caller parses; zlib and
+    zstd release the GIL, so the two overlap.
+    """
+    blocks = queue.Queue(maxsize=prefetch)
+
+    def produce():
+        try:
+            for path in paths:
+                lines = []
+                for line in iter_lines(path):
+                    lines.append(line)
+                    if len(lines) == 1024:
+                        blocks.put(lines)
+                        lines = []
+                blocks.put(lines)
+            blocks.put(None)
+        except BaseException as e:
+            blocks.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        lines = blocks.get()
+        if lines is None:
+            return
+        if isinstance(lines, BaseException):
+            raise lines
+        for line in lines:
+            yield line.decode()
+
+
+def compress_raw_features(path, out_path, lines_per_frame=1 << 14, level=None):
+    """
+    Compress the raw features in path to out_path (.gz or .zst) as independent frames of lines_per_frame lines and
+    write its index, so that the compressed copy can be sharded and entered at any frame
+    """
+    codec_name = codec(out_path)
+    if codec_name == "gzip":
+        import gzip
+
+        def compress(data):
+            return gzip.compress(data, compresslevel=9 if level is None else level)
+
+    elif codec_name == "zstd":
+        import zstandard
+        compress = zstandard.ZstdCompressor(level=3 if level is None else level).compress
+    else:
+        raise Exception(f"Unknown compressed raw feature suffix of {out_path}")
+
+    entries = []
+    nlines = 0
+    with open(out_path, "wb") as out:
+        lines = []
+        for line in iter_lines(path):
+            lines.append(line + b"\n")
+            if len(lines) == lines_per_frame:
+                entries.append((out.tell(), nlines))
+                out.write(compress(b"".join(lines)))
+                nlines += len(lines)
+                lines = []
+        if lines:
+            entries.append((out.tell(), nlines))
+            out.write(compress(b"".join(lines)))
+            nlines += len(lines)
+        entries.append((out.tell(), nlines))
+    np.save(out_path + index_suffix, np.array(entries, dtype=np.int64).reshape(-1, 2))